@@ -1,21 +1,165 @@
 import json
+import logging
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+import orjson
+
 
 DB_PATH = Path("storage/app.db")
 
+# WAL tuning: checkpoint less often during bursts, and wait on locks instead of failing.
+WAL_AUTOCHECKPOINT_PAGES = 8000
+BUSY_TIMEOUT_MS = 5000
+# Per-connection read tuning (see Database._connect). Connections are per thread and stay open,
+# and the anyio / to_thread pools own many, so the private page cache is kept small; the memory
+# map is file-backed and shared through the OS page cache instead of duplicated per connection.
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 4 * 1024
+# Job log rows written since the last explicit checkpoint (shared across Database instances).
+CHECKPOINT_LOG_THRESHOLD = 500
+_log_writes = 0
+_log_writes_lock = threading.Lock()
+# Background job-log writer: flush at most this many rows, or whatever arrived within this window.
+LOG_BATCH_MAX = 256
+LOG_BATCH_WINDOW = 0.05
+# Prepared statements kept per connection (sqlite3 default is 128)
+STATEMENT_CACHE_SIZE = 256
+
+# Settings read through get_setting_cached: (db path, key) -> (value or None, monotonic time read)
+SETTING_CACHE_TTL = 5.0
+_setting_cache: Dict[Tuple[Path, str], Tuple[Optional[str], float]] = {}
+
+# Message ids recently passed to mark_if_new: (db path, msg_id), oldest first
+RECENT_MSG_IDS_MAX = 10000
+_recent_msg_ids: "OrderedDict[Tuple[Path, str], None]" = OrderedDict()
+_recent_msg_ids_lock = threading.Lock()
+
+# One connection per thread and database file, opened on first use (see Database._connect)
+_thread_local = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+# JSON columns round-trip automatically: dict/list parameters are serialized on the way in,
+# and columns declared (or aliased, e.g. 'x AS "x [JSON]"') as JSON are parsed on the way out.
+# Values stay TEXT (json.dumps) so SQLite's json1 functions keep working on them; converters
+# receive bytes, which orjson parses directly without a decode step.
+sqlite3.register_adapter(dict, json.dumps)
+sqlite3.register_adapter(list, json.dumps)
+sqlite3.register_converter("JSON", orjson.loads)
+
+
+def _utc_ts() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def _count_log_writes(n: int = 1) -> None:
+    global _log_writes
+    with _log_writes_lock:
+        _log_writes += n
+
+
+class _LogWriter:
+    """
+    Daemon thread that drains queued job log entries and inserts them with a single
+    executemany per batch, so bursts cost one transaction instead of one per entry.
+    """
+
+    def __init__(self, db: "Database"):
+        self.db = db
+        self.q: "queue.Queue[Tuple[int, Dict[str, Any], str]]" = queue.Queue()
+        self.t = threading.Thread(target=self._run, name="job-log-writer", daemon=True)
+        self.t.start()
+
+    def put(self, job_id: int, entry: Dict[str, Any], ts: str):
+        self.q.put((job_id, entry, ts))
+
+    def _run(self):
+        while True:
+            batch = [self.q.get()]
+            deadline = time.monotonic() + LOG_BATCH_WINDOW
+            while len(batch) < LOG_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._insert(batch)
+                _count_log_writes(len(batch))
+            except Exception as e:
+                # One bad row (e.g. an entry the JSON adapter rejects) fails the whole executemany:
+                # retry row by row so it doesn't take the rest of the batch with it
+                logger.warning("job log batch of %d failed (%s); retrying row by row", len(batch), e)
+                written = 0
+                for row in batch:
+                    try:
+                        self._insert([row])
+                        written += 1
+                    except Exception as row_exc:
+                        # Never let a bad entry kill the writer thread
+                        logger.warning("dropped job log entry for job %s: %s", row[0], row_exc)
+                _count_log_writes(written)
+
+    def _insert(self, rows: List[Tuple[int, Dict[str, Any], str]]):
+        with self.db._conn() as con:
+            with con:
+                con.executemany(
+                    "INSERT INTO job_logs (job_id, entry_json, created_at) VALUES (?, ?, ?)",
+                    rows,
+                )
+
+
+class _TxConn:
+    """
+    Connection handed out inside Database.transaction(): the per-method commit() calls
+    become no-ops so every write lands in the one enclosing transaction.
+    """
+
+    def __init__(self, con: sqlite3.Connection):
+        self._con = con
+
+    def commit(self):
+        pass
+
+    def __getattr__(self, name: str):
+        return getattr(self._con, name)
+
+
+_log_writers: Dict[Path, _LogWriter] = {}
+_log_writers_lock = threading.Lock()
+
+
+def _get_log_writer(db: "Database") -> _LogWriter:
+    with _log_writers_lock:
+        writer = _log_writers.get(db.path)
+        if writer is None:
+            writer = _LogWriter(Database(db.path))
+            _log_writers[db.path] = writer
+        return writer
+
 
 class Database:
     def __init__(self, path: Path = DB_PATH):
         self.path = path
         self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._tx: Optional[_TxConn] = None
 
     def init(self):
         with self._conn() as con:
             cur = con.cursor()
+            # journal_mode is persistent in the database file, so setting it once here is enough
+            cur.execute("PRAGMA journal_mode=WAL")
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS jobs (
@@ -28,7 +172,7 @@ class Database:
                     updated_at TEXT,
                     pdf_path TEXT,
                     pdf_meta_path TEXT,
-                    upload_meta TEXT
+                    upload_meta JSON
                 )
                 """
             )
@@ -37,7 +181,7 @@ class Database:
                 CREATE TABLE IF NOT EXISTS media (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     job_id INTEGER,
-                    payload_json TEXT,
+                    payload_json JSON,
                     local_path TEXT
                 )
                 """
@@ -47,7 +191,7 @@ class Database:
                 CREATE TABLE IF NOT EXISTS job_logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     job_id INTEGER,
-                    entry_json TEXT,
+                    entry_json JSON,
                     created_at TEXT
                 )
                 """
@@ -68,60 +212,197 @@ class Database:
                 )
                 """
             )
+            # Duplicate-delivery lookups by message id
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_instance_msg ON jobs(instance_id, msg_id)")
+            # Per-job reads done by every worker, and the startup replay by status; without these
+            # each one scans the whole table, which only grows
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_media_job ON media(job_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_job_logs_job ON job_logs(job_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
             con.commit()
 
+    def _connect(self) -> sqlite3.Connection:
+        """
+        The calling thread's long-lived connection to this database. Reusing it skips the
+        open + PRAGMA round on every call and keeps sqlite3's per-connection statement cache warm.
+        """
+        cons = getattr(_thread_local, "cons", None)
+        if cons is None:
+            cons = _thread_local.cons = {}
+        con = cons.get(self.path)
+        if con is None:
+            con = sqlite3.connect(
+                self.path,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+            # Rows index by column name as well as position, and dict(row) gives a plain dict
+            con.row_factory = sqlite3.Row
+            con.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            con.execute(f"PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT_PAGES}")
+            # In WAL mode NORMAL only syncs at checkpoints; a power loss may drop the last commits but never corrupts
+            con.execute("PRAGMA synchronous=NORMAL")
+            # Temp b-trees (sorts, GROUP BY) in RAM, reads through a memory map, and a 4 MiB page cache
+            con.execute("PRAGMA temp_store=MEMORY")
+            con.execute(f"PRAGMA mmap_size={MMAP_SIZE_BYTES}")
+            con.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+            cons[self.path] = con
+        return con
+
     @contextmanager
     def _conn(self):
-        con = sqlite3.connect(self.path)
+        if self._tx is not None:
+            yield self._tx
+            return
+        con = self._connect()
         try:
             yield con
-        finally:
-            con.close()
+        except BaseException:
+            # Don't leave a half-done write open on the shared connection for the next caller to commit
+            if con.in_transaction:
+                con.rollback()
+            raise
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several writes into one commit:
+
+            with db.transaction() as tx:
+                tx.update_job_status(job_id, "SENT")
+                tx.append_job_log(job_id, {...})
+
+        tx has the same methods as Database; everything commits together on exit,
+        or rolls back if the block raises.
 
-    def create_job(self, sender: str, msg_id: str, payload: Dict[str, Any], instance_id: str) -> int:
-        from datetime import datetime
+        The block must not await, and must write only through tx. The connection is shared
+        per thread, so any other Database write on this thread (another coroutine running
+        during an await, or a plain db.* call inside the block) commits the open
+        BEGIN IMMEDIATE early.
+        """
+        with self._conn() as con:
+            if self._tx is not None:
+                # Nested: join the outer transaction
+                yield self
+                return
+            con.execute("BEGIN IMMEDIATE")
+            tx = Database.__new__(Database)
+            tx.path = self.path
+            tx._tx = _TxConn(con)
+            with con:
+                yield tx
 
+    def checkpoint(self):
+        """
+        Fold the WAL back into the main database file and truncate it.
+        Meant to run off the event loop (e.g. via asyncio.to_thread).
+        """
+        global _log_writes
+        with self._conn() as con:
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        with _log_writes_lock:
+            _log_writes = 0
+
+    def checkpoint_if_needed(self, threshold: int = CHECKPOINT_LOG_THRESHOLD) -> bool:
+        with _log_writes_lock:
+            pending = _log_writes
+        if pending < threshold:
+            return False
+        self.checkpoint()
+        return True
+
+    def create_job(self, sender: str, msg_id: str, payload: Dict[str, Any], instance_id: str, status: str = "NEW") -> int:
+        ts = _utc_ts()
         with self._conn() as con:
             cur = con.cursor()
             cur.execute(
                 "INSERT INTO jobs (sender, msg_id, instance_id, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (sender, msg_id, instance_id, "NEW", datetime.utcnow().isoformat() + "Z", datetime.utcnow().isoformat() + "Z"),
+                (sender, msg_id, instance_id, status, ts, ts),
             )
             job_id = cur.lastrowid
             # Store raw payload log entry
             cur.execute(
                 "INSERT INTO job_logs (job_id, entry_json, created_at) VALUES (?, ?, ?)",
-                (job_id, json.dumps({"incoming_payload": payload}), datetime.utcnow().isoformat() + "Z"),
+                (job_id, {"incoming_payload": payload}, ts),
             )
             con.commit()
+            _count_log_writes()
             return int(job_id)
 
     def add_media(self, job_id: int, media_payload: Dict[str, Any]):
         with self._conn() as con:
             cur = con.cursor()
             cur.execute(
-                "INSERT INTO media (job_id, payload_json) VALUES (?, ?)", (job_id, json.dumps(media_payload))
+                "INSERT INTO media (job_id, payload_json) VALUES (?, ?)", (job_id, media_payload)
+            )
+            con.commit()
+
+    def add_medias(self, job_id: int, media_payloads: Iterable[Dict[str, Any]]):
+        """add_media for several payloads in one statement and commit."""
+        with self._conn() as con:
+            con.executemany(
+                "INSERT INTO media (job_id, payload_json) VALUES (?, ?)", [(job_id, m) for m in media_payloads]
             )
             con.commit()
 
     def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
         with self._conn() as con:
             cur = con.cursor()
-            row = cur.execute("SELECT id, sender, msg_id, instance_id, status, created_at, updated_at, pdf_path, pdf_meta_path, upload_meta FROM jobs WHERE id=?", (job_id,)).fetchone()
-            if not row:
-                return None
-            keys = ["id", "sender", "msg_id", "instance_id", "status", "created_at", "updated_at", "pdf_path", "pdf_meta_path", "upload_meta"]
-            data = dict(zip(keys, row))
-            return data
+            row = cur.execute(
+                "SELECT id, sender, msg_id, instance_id, status, created_at, updated_at, pdf_path, pdf_meta_path, "
+                "upload_meta AS \"upload_meta [JSON]\" FROM jobs WHERE id=?",
+                (job_id,),
+            ).fetchone()
+            return dict(row) if row else None
+
+    def get_job_by_msg(self, instance_id: str, msg_id: str) -> Optional[Dict[str, Any]]:
+        """Most recent job created for this message, if any."""
+        with self._conn() as con:
+            row = con.execute(
+                "SELECT id, sender, msg_id, instance_id, status, created_at FROM jobs "
+                "WHERE instance_id=? AND msg_id=? ORDER BY id DESC LIMIT 1",
+                (instance_id, msg_id),
+            ).fetchone()
+            return dict(row) if row else None
 
     def get_media_for_job(self, job_id: int) -> List[Dict[str, Any]]:
         with self._conn() as con:
             cur = con.cursor()
-            rows = cur.execute("SELECT id, payload_json, local_path FROM media WHERE job_id=?", (job_id,)).fetchall()
-            res = []
-            for r in rows:
-                res.append({"id": r[0], "payload": json.loads(r[1]), "local_path": r[2]})
-            return res
+            rows = cur.execute(
+                "SELECT id, payload_json AS \"payload_json [JSON]\", local_path FROM media WHERE job_id=?", (job_id,)
+            ).fetchall()
+            return [{"id": r["id"], "payload": r["payload_json"], "local_path": r["local_path"]} for r in rows]
+
+    def load_job_with_media(self, job_id: int) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        """get_job + get_media_for_job in one query; (None, []) when the job doesn't exist."""
+        with self._conn() as con:
+            rows = con.execute(
+                "SELECT j.id, j.sender, j.msg_id, j.instance_id, j.status, j.created_at, j.updated_at, j.pdf_path, "
+                "j.pdf_meta_path, j.upload_meta AS \"upload_meta [JSON]\", m.id AS media_id, "
+                "m.payload_json AS \"payload_json [JSON]\", m.local_path AS media_local_path "
+                "FROM jobs j LEFT JOIN media m ON m.job_id = j.id WHERE j.id=? ORDER BY m.id",
+                (job_id,),
+            ).fetchall()
+        if not rows:
+            return None, []
+        r0 = rows[0]
+        job = {
+            "id": r0["id"], "sender": r0["sender"], "msg_id": r0["msg_id"], "instance_id": r0["instance_id"],
+            "status": r0["status"], "created_at": r0["created_at"], "updated_at": r0["updated_at"],
+            "pdf_path": r0["pdf_path"], "pdf_meta_path": r0["pdf_meta_path"], "upload_meta": r0["upload_meta"],
+        }
+        media = [
+            {"id": r["media_id"], "payload": r["payload_json"], "local_path": r["media_local_path"]}
+            for r in rows
+            if r["media_id"] is not None
+        ]
+        return job, media
+
+    def update_media_local_paths(self, paths: Iterable[Tuple[int, str]]):
+        """update_media_local_path for several (media_id, local_path) pairs in one statement and commit."""
+        with self._conn() as con:
+            con.executemany("UPDATE media SET local_path=? WHERE id=?", [(lp, mid) for mid, lp in paths])
+            con.commit()
 
     def update_media_local_path(self, media_id: int, local_path: str):
         with self._conn() as con:
@@ -130,11 +411,9 @@ class Database:
             con.commit()
 
     def update_job_status(self, job_id: int, status: str):
-        from datetime import datetime
-
         with self._conn() as con:
             cur = con.cursor()
-            cur.execute("UPDATE jobs SET status=?, updated_at=? WHERE id=?", (status, datetime.utcnow().isoformat() + "Z", job_id))
+            cur.execute("UPDATE jobs SET status=?, updated_at=? WHERE id=?", (status, _utc_ts(), job_id))
             con.commit()
 
     def update_job_pdf(self, job_id: int, pdf_path: Path, meta_path: Path):
@@ -146,43 +425,65 @@ class Database:
     def update_job_upload(self, job_id: int, upload_meta: Dict[str, Any]):
         with self._conn() as con:
             cur = con.cursor()
-            cur.execute("UPDATE jobs SET upload_meta=? WHERE id=?", (json.dumps(upload_meta), job_id))
+            cur.execute("UPDATE jobs SET upload_meta=? WHERE id=?", (upload_meta, job_id))
             con.commit()
 
-    def append_job_log(self, job_id: int, entry: Dict[str, Any]):
-        from datetime import datetime
+    def get_job_ids_by_status(self, statuses: Iterable[str]) -> List[int]:
+        statuses = list(statuses)
+        marks = ", ".join("?" * len(statuses))
+        with self._conn() as con:
+            rows = con.execute(f"SELECT id FROM jobs WHERE status IN ({marks}) ORDER BY id ASC", statuses).fetchall()
+            return [r["id"] for r in rows]
 
+    def append_job_log(self, job_id: int, entry: Dict[str, Any]):
         with self._conn() as con:
             cur = con.cursor()
             cur.execute(
                 "INSERT INTO job_logs (job_id, entry_json, created_at) VALUES (?, ?, ?)",
-                (job_id, json.dumps(entry), datetime.utcnow().isoformat() + "Z"),
+                (job_id, entry, _utc_ts()),
             )
             con.commit()
+        _count_log_writes()
+
+    def append_job_log_async(self, job_id: int, entry: Dict[str, Any]):
+        """
+        Non-blocking append_job_log: the row is written shortly after by the background
+        log writer. Use only for entries nothing reads back immediately.
+        """
+        _get_log_writer(self).put(job_id, entry, _utc_ts())
 
     def get_job_logs(self, job_id: int) -> List[Dict[str, Any]]:
         with self._conn() as con:
             cur = con.cursor()
             rows = cur.execute(
-                "SELECT id, job_id, entry_json, created_at FROM job_logs WHERE job_id=? ORDER BY id ASC",
+                "SELECT id, job_id, entry_json AS \"entry_json [JSON]\", created_at FROM job_logs WHERE job_id=? ORDER BY id ASC",
                 (job_id,),
             ).fetchall()
-            res = []
-            for r in rows:
-                res.append({"id": r[0], "job_id": r[1], "entry": json.loads(r[2]) if r[2] else None, "created_at": r[3]})
-            return res
+            return [{"id": r["id"], "job_id": r["job_id"], "entry": r["entry_json"], "created_at": r["created_at"]} for r in rows]
 
     def get_recent_logs(self, limit: int = 100) -> List[Dict[str, Any]]:
         with self._conn() as con:
             cur = con.cursor()
+            if sqlite3.sqlite_version_info >= (3, 38, 0):
+                # Build the whole result as one JSON array inside SQLite: one decode instead of one per row
+                try:
+                    row = cur.execute(
+                        """
+                        SELECT json_group_array(json_object(
+                            'id', id, 'job_id', job_id, 'entry', json(entry_json), 'created_at', created_at
+                        )) AS "logs [JSON]"
+                        FROM (SELECT id, job_id, entry_json, created_at FROM job_logs ORDER BY id DESC LIMIT ?)
+                        """,
+                        (limit,),
+                    ).fetchone()
+                    return row["logs"] if row and row["logs"] else []
+                except sqlite3.OperationalError:
+                    pass  # e.g. a malformed legacy row; fall back to per-row decoding
             rows = cur.execute(
-                "SELECT id, job_id, entry_json, created_at FROM job_logs ORDER BY id DESC LIMIT ?",
+                "SELECT id, job_id, entry_json AS \"entry_json [JSON]\", created_at FROM job_logs ORDER BY id DESC LIMIT ?",
                 (limit,),
             ).fetchall()
-            res = []
-            for r in rows:
-                res.append({"id": r[0], "job_id": r[1], "entry": json.loads(r[2]) if r[2] else None, "created_at": r[3]})
-            return res
+            return [{"id": r["id"], "job_id": r["job_id"], "entry": r["entry_json"], "created_at": r["created_at"]} for r in rows]
 
     def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
         with self._conn() as con:
@@ -190,13 +491,29 @@ class Database:
             row = cur.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
             if not row:
                 return default
-            return row[0]
+            return row["value"]
+
+    def get_setting_cached(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        get_setting for hot paths (per-message checks): serves values up to SETTING_CACHE_TTL
+        seconds old. set_setting in this process drops the cached entry immediately.
+        """
+        ck = (self.path, key)
+        hit = _setting_cache.get(ck)
+        now = time.monotonic()
+        if hit is not None and now - hit[1] < SETTING_CACHE_TTL:
+            value = hit[0]
+        else:
+            value = self.get_setting(key, None)
+            _setting_cache[ck] = (value, now)
+        return default if value is None else value
 
     def set_setting(self, key: str, value: str):
         with self._conn() as con:
             cur = con.cursor()
             cur.execute("INSERT INTO settings(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
             con.commit()
+        _setting_cache.pop((self.path, key), None)
 
     # Idempotency helpers -------------------------------------------------
 
@@ -206,16 +523,46 @@ class Database:
             row = cur.execute("SELECT 1 FROM processed_messages WHERE msg_id=?", (msg_id,)).fetchone()
             return bool(row)
 
+    def mark_if_new(self, msg_id: str) -> bool:
+        """
+        Atomically record msg_id as processed. Returns False if it was already recorded, so
+        check-and-mark is one statement and two concurrent deliveries can't both win. Recent ids
+        are remembered in-process, so the usual quick redeliveries never reach SQLite.
+        """
+        key = (self.path, msg_id)
+        with _recent_msg_ids_lock:
+            if key in _recent_msg_ids:
+                _recent_msg_ids.move_to_end(key)
+                return False
+        with self._conn() as con:
+            cur = con.execute(
+                "INSERT OR IGNORE INTO processed_messages (msg_id, created_at) VALUES (?, ?)",
+                (msg_id, _utc_ts()),
+            )
+            con.commit()
+            is_new = cur.rowcount == 1
+        with _recent_msg_ids_lock:
+            _recent_msg_ids[key] = None
+            if len(_recent_msg_ids) > RECENT_MSG_IDS_MAX:
+                _recent_msg_ids.popitem(last=False)
+        return is_new
+
     def mark_processed(self, msg_id: str):
-        from datetime import datetime
         with self._conn() as con:
             cur = con.cursor()
             cur.execute(
                 "INSERT OR IGNORE INTO processed_messages (msg_id, created_at) VALUES (?, ?)",
-                (msg_id, datetime.utcnow().isoformat() + "Z"),
+                (msg_id, _utc_ts()),
             )
             con.commit()
 
 
+_default_db: Optional[Database] = None
+
+
 def get_db() -> Database:
-    return Database()
\ No newline at end of file
+    # Database holds no per-request state (connections are per thread), so share one instance
+    global _default_db
+    if _default_db is None:
+        _default_db = Database()
+    return _default_db
\ No newline at end of file
@@ -1,29 +1,226 @@
+import datetime
+import functools
+import hashlib
 import os
-from typing import Dict, List, Optional, Tuple
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 import google.generativeai as genai
+import orjson
+from google.generativeai import client as genai_client
 
 from .db import Database
 
 
 # In-memory rolling chat history for normal (non-Q&A) mode.
 # Stores the last 20 messages (user/assistant combined) per chat_id.
-_CHAT_HISTORY: Dict[str, List[Dict[str, str]]] = {}
+_CHAT_HISTORY: Dict[str, Deque[Dict[str, str]]] = {}
+# Rendered "User: ... / Assistant: ..." block per chat_id; dropped whenever that chat's history changes.
+_HISTORY_BLOCK: Dict[str, str] = {}
+
+
+# Output caps for short structured answers: decode time grows with output length, and these
+# calls only need a line or a small JSON object.
+_REWRITE_CFG = genai.GenerationConfig(max_output_tokens=48, temperature=0.2, top_p=0.9, stop_sequences=["\n\n"])
+_VERIFY_CFG = genai.GenerationConfig(max_output_tokens=96, temperature=0.2)
+_SUMMARY_CFG = genai.GenerationConfig(max_output_tokens=120, temperature=0.2)
+
+# First flat {...} object mentioning "match" in a verification answer
+_MATCH_OBJ_RE = re.compile(rb'\{[^{}]*"match"[^{}]*\}')
+# JSON array answer from verify_images_batch
+_VERDICT_ARRAY_RE = re.compile(rb"\[.*\]", re.S)
+
+# GEMINI_API_KEY lookups are cached briefly so hot chat paths skip the settings query;
+# a key changed in the WebUI is picked up within this many seconds.
+API_KEY_TTL = 60.0
+_api_key_cache: Tuple[float, Optional[str]] = (0.0, None)
+
+
+@functools.lru_cache(maxsize=1)
+def _db() -> Database:
+    return Database()
+
+
+def invalidate_api_key_cache() -> None:
+    """Forget the cached GEMINI_API_KEY (call after it is changed in the WebUI)."""
+    global _api_key_cache
+    _api_key_cache = (0.0, None)
+
+
+def _resolve_api_key() -> Optional[str]:
+    global _api_key_cache
+    now = time.monotonic()
+    expires, key = _api_key_cache
+    if now < expires:
+        return key
+    key = _db().get_setting("GEMINI_API_KEY", None) or os.getenv("GEMINI_API_KEY")
+    _api_key_cache = (now + API_KEY_TTL, key)
+    return key
+
+
+# genai keeps one process-global set of clients, configured with a single key. Responders and
+# GeminiFileQA may use different keys, so every path that reaches those clients goes through here.
+_genai_lock = threading.RLock()
+_configured_key: Optional[str] = None
+
+
+def use_api_key(api_key: str) -> None:
+    """
+    Point genai's global clients (file uploads, context caching) at api_key before using them;
+    reconfigures only when the key differs from the last one.
+    """
+    global _configured_key
+    with _genai_lock:
+        if api_key != _configured_key:
+            genai.configure(api_key=api_key)
+            _configured_key = api_key
+
+
+def _bind_client(api_key: str, model: "genai.GenerativeModel") -> "genai.GenerativeModel":
+    # A GenerativeModel otherwise picks up the global client lazily on its first call, i.e. with
+    # whatever key was configured last; bind the one for api_key now
+    with _genai_lock:
+        use_api_key(api_key)
+        model._client = genai_client.get_default_generative_client()
+    return model
+
+
+@functools.lru_cache(maxsize=4)
+def build_model(api_key: str, model: str) -> "genai.GenerativeModel":
+    # configure() + GenerativeModel() only run once per (key, model), not once per reply;
+    # the model keeps the client for its own key even after another key is configured
+    return _bind_client(api_key, genai.GenerativeModel(model))
+
+
+# Gemini context caching for long system prompts: the prompt is uploaded once as CachedContent
+# and later turns only send history + the new message. The API rejects small prefixes, so short
+# prompts are never tried; failures are remembered for a while instead of retried every turn.
+CONTEXT_CACHE_MIN_CHARS = 16000
+CONTEXT_CACHE_TTL = 3600
+CONTEXT_CACHE_RETRY_AFTER = 600
+_context_models: Dict[bytes, Tuple[float, Any]] = {}
+_context_models_lock = threading.Lock()
+
+
+def _cached_prompt_model(api_key: str, model: str, system_prompt: str) -> Optional["genai.GenerativeModel"]:
+    if len(system_prompt) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+    key = hashlib.blake2b(f"{api_key}|{model}|{system_prompt}".encode("utf-8"), digest_size=16).digest()
+    now = time.monotonic()
+    with _context_models_lock:
+        hit = _context_models.get(key)
+        if hit is not None and now < hit[0]:
+            return hit[1]
+    try:
+        with _genai_lock:
+            use_api_key(api_key)
+            cache = genai.caching.CachedContent.create(
+                model=f"models/{model}",
+                system_instruction=system_prompt,
+                ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL),
+            )
+        cached_model = _bind_client(api_key, genai.GenerativeModel.from_cached_content(cached_content=cache))
+        # Stop using it a minute before the server-side TTL runs out
+        entry = (now + CONTEXT_CACHE_TTL - 60, cached_model)
+    except Exception:
+        entry = (now + CONTEXT_CACHE_RETRY_AFTER, None)
+    with _context_models_lock:
+        _context_models[key] = entry
+    return entry[1]
+
+
+# Turns that fell out of the window are folded into a short per-chat summary instead of being
+# forgotten. Evictions are buffered and summarized SUMMARY_BATCH at a time on a background thread.
+SUMMARY_BATCH = 5
+_CHAT_SUMMARY: Dict[str, str] = {}
+_EVICTED: Dict[str, List[Dict[str, str]]] = {}
+_summary_lock = threading.Lock()
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
 
 
 def _append_chat_history(chat_id: str, role: str, content: str, limit: int = 20) -> None:
     if not chat_id:
         return
-    items = _CHAT_HISTORY.setdefault(chat_id, [])
+    items = _CHAT_HISTORY.setdefault(chat_id, deque(maxlen=limit))
+    if items.maxlen is not None and len(items) >= items.maxlen:
+        with _summary_lock:
+            _EVICTED.setdefault(chat_id, []).append(items[0])
+    # maxlen drops the oldest entry on append, keeping the window bounded in O(1)
     items.append({"role": role, "content": content})
-    if len(items) > limit:
-        del items[:-limit]
+    _HISTORY_BLOCK.pop(chat_id, None)
+
+
+def _take_evicted(chat_id: Optional[str]) -> List[Dict[str, str]]:
+    """Pop the buffered evicted turns for chat_id once there are enough to summarize."""
+    if not chat_id:
+        return []
+    with _summary_lock:
+        pending = _EVICTED.get(chat_id) or []
+        if len(pending) < SUMMARY_BATCH:
+            return []
+        return _EVICTED.pop(chat_id)
 
 
 def _get_chat_history(chat_id: Optional[str], limit: int = 20) -> List[Dict[str, str]]:
     if not chat_id:
         return []
-    return (_CHAT_HISTORY.get(chat_id) or [])[-limit:]
+    items = _CHAT_HISTORY.get(chat_id)
+    if not items:
+        return []
+    if len(items) <= limit:
+        return list(items)
+    return list(items)[-limit:]
+
+
+# Replies to context-free turns ("hi", "thanks", ...) keyed on (system prompt, normalized text).
+# Only used when the chat has no history, so a reused reply can't contradict earlier turns.
+REPLY_CACHE_MAX = 2048
+REPLY_CACHE_TTL = 300.0
+_reply_cache: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+_reply_cache_lock = threading.Lock()
+
+
+def _reply_cache_key(system_prompt: Optional[str], user_text: str) -> bytes:
+    raw = f"{(system_prompt or '').strip()}|{user_text.strip().lower()}".encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def _reply_cache_get(key: bytes) -> Optional[str]:
+    with _reply_cache_lock:
+        hit = _reply_cache.get(key)
+        if hit is None:
+            return None
+        expires, reply = hit
+        if time.monotonic() >= expires:
+            del _reply_cache[key]
+            return None
+        _reply_cache.move_to_end(key)
+        return reply
+
+
+def _reply_cache_put(key: bytes, reply: str) -> None:
+    with _reply_cache_lock:
+        _reply_cache[key] = (time.monotonic() + REPLY_CACHE_TTL, reply)
+        _reply_cache.move_to_end(key)
+        while len(_reply_cache) > REPLY_CACHE_MAX:
+            _reply_cache.popitem(last=False)
+
+
+def _history_block(chat_id: Optional[str]) -> str:
+    if not chat_id:
+        return ""
+    block = _HISTORY_BLOCK.get(chat_id)
+    if block is None:
+        block = "\n".join(
+            f"{'User' if h.get('role', 'user') == 'user' else 'Assistant'}: {h.get('content', '')}"
+            for h in _get_chat_history(chat_id, limit=20)
+        )
+        _HISTORY_BLOCK[chat_id] = block
+    return block
 
 
 class GeminiResponder:
@@ -31,40 +228,99 @@ class GeminiResponder:
     Responder for all intents and features. Always uses Gemini 2.5 Flash-Lite.
     """
     def __init__(self, api_key: Optional[str] = None, model_name: Optional[str] = None):
-        db = Database()
         if api_key is None:
-            api_key = db.get_setting("GEMINI_API_KEY", None) or os.getenv("GEMINI_API_KEY")
+            api_key = _resolve_api_key()
         if not api_key:
             raise RuntimeError("GEMINI_API_KEY is not set")
         # Force a single model across the app to avoid duplicate behaviors
         model = "gemini-2.5-flash-lite"
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model)
+        self._api_key = api_key
+        self._model_name = model
+        self.model = build_model(api_key, model)
 
-    def generate(self, user_text: str, system_prompt: Optional[str] = None, chat_id: Optional[str] = None) -> str:
-        """
-        Text generation with short-term memory for normal chat mode.
-        If chat_id is provided, we include the last 20 messages (user/assistant) as context and
-        then append this turn to the rolling memory.
-        """
+    def _chat_parts(self, user_text: str, system_prompt: Optional[str], chat_id: Optional[str]) -> List[object]:
         # Build parts: system, history turns, current user, and assistant cue
         parts: List[object] = []
         if system_prompt:
             parts.append({"text": system_prompt.strip()})
 
-        # Include last N turns as simple "User:" / "Assistant:" text snippets
-        history = _get_chat_history(chat_id, limit=20)
-        for h in history:
-            role = h.get("role", "user")
-            content = h.get("content", "")
-            prefix = "User" if role == "user" else "Assistant"
-            parts.append({"text": f"{prefix}: {content}"})
+        # Summary of turns older than the window, if any
+        summary = _CHAT_SUMMARY.get(chat_id or "")
+        if summary:
+            parts.append({"text": f"Prior context: {summary}"})
+
+        # Last N turns as one "User:" / "Assistant:" text block (same tokens, one part instead of N)
+        history = _history_block(chat_id)
+        if history:
+            parts.append({"text": history})
 
         # Current user message and assistant cue
-        parts.append({"text": f"User: {user_text.strip()}"})
-        parts.append({"text": "Assistant:"})
+        parts.append({"text": f"User: {user_text.strip()}\nAssistant:"})
+        return parts
+
+    def _summarize(self, chat_id: str, evicted: List[Dict[str, str]]) -> None:
+        """
+        Fold turns evicted from the sliding window (plus any earlier summary) into a short summary.
+        Runs on the background summary thread; failures just leave the previous summary in place.
+        """
+        try:
+            lines = [
+                f"{'User' if h.get('role', 'user') == 'user' else 'Assistant'}: {h.get('content', '')}"
+                for h in evicted
+            ]
+            previous = _CHAT_SUMMARY.get(chat_id)
+            prompt = (
+                "Summarize the following prior conversation in at most 60 words. "
+                "Keep names, facts and open requests. Return only the summary.\n\n"
+                + (f"Earlier summary: {previous}\n" if previous else "")
+                + "\n".join(lines)
+            )
+            resp = self.model.generate_content(prompt, generation_config=_SUMMARY_CFG)
+            text = (resp.text or "").strip()
+            if text:
+                with _summary_lock:
+                    _CHAT_SUMMARY[chat_id] = text
+        except Exception:
+            pass
+
+    def generate(
+        self,
+        user_text: str,
+        system_prompt: Optional[str] = None,
+        chat_id: Optional[str] = None,
+        timing: Optional[Dict[str, Optional[float]]] = None,
+    ) -> str:
+        """
+        Text generation with short-term memory for normal chat mode.
+        If chat_id is provided, we include the last 20 messages (user/assistant) as context and
+        then append this turn to the rolling memory. If a timing dict is passed, the model call's
+        latency is stored in timing["latency"] (seconds); a reply served from the cache leaves it None.
+        It is per call rather than on the instance because one responder serves concurrent replies.
+        """
+        if timing is not None:
+            timing["latency"] = None
+        cache_key = None
+        if user_text.strip() and not _CHAT_HISTORY.get(chat_id or ""):
+            cache_key = _reply_cache_key(system_prompt, user_text)
+            cached = _reply_cache_get(cache_key)
+            if cached is not None:
+                if chat_id:
+                    _append_chat_history(chat_id, "user", user_text.strip())
+                    _append_chat_history(chat_id, "assistant", cached)
+                return cached
 
-        resp = self.model.generate_content(parts)
+        model = self.model
+        cached_model = _cached_prompt_model(self._api_key, self._model_name, system_prompt.strip()) if system_prompt else None
+        if cached_model is not None:
+            # System prompt already lives in the cached content; send only history + this turn
+            model = cached_model
+            parts = self._chat_parts(user_text, None, chat_id)
+        else:
+            parts = self._chat_parts(user_text, system_prompt, chat_id)
+        started = time.monotonic()
+        resp = model.generate_content(parts)
+        if timing is not None:
+            timing["latency"] = time.monotonic() - started
         text = ""
         try:
             text = resp.text or ""
@@ -73,13 +329,18 @@ class GeminiResponder:
                 text = "".join(p.text for p in resp.candidates[0].content.parts)
             except Exception:
                 text = ""
-        reply = (text.strip() or "Thanks for your message.")
+        text = text.strip()
+        if cache_key is not None and text:
+            _reply_cache_put(cache_key, text)
+        reply = (text or "Thanks for your message.")
 
         # Persist to in-memory history
         if chat_id:
             _append_chat_history(chat_id, "user", user_text.strip())
             _append_chat_history(chat_id, "assistant", reply)
-
+            evicted = _take_evicted(chat_id)
+            if evicted:
+                _summary_executor.submit(self._summarize, chat_id, evicted)
         return reply
 
     def rewrite_search_query(self, user_query: str) -> str:
@@ -92,7 +353,7 @@ class GeminiResponder:
                 "Include key synonyms and proper nouns if relevant. Return only the improved query.\\n\\n"
                 f"Query: {user_query}"
             )
-            resp = self.model.generate_content(prompt)
+            resp = self.model.generate_content(prompt, generation_config=_REWRITE_CFG)
             return (resp.text or "").strip() or user_query
         except Exception:
             return user_query
@@ -103,6 +364,7 @@ class GeminiResponder:
         Returns (is_match, brief_reason).
         """
         try:
+            use_api_key(self._api_key)
             handle = genai.upload_file(path=image_path)
             parts = [
                 {"text": (
@@ -114,12 +376,74 @@ class GeminiResponder:
                 handle,
                 {"text": f"User request: {query}"},
             ]
-            resp = self.model.generate_content(parts)
+            resp = self.model.generate_content(parts, generation_config=_VERIFY_CFG)
             txt = (resp.text or "").strip()
-            # naive parse
+            # Parse the JSON object the prompt asks for; substring checks only if that fails
+            m = _MATCH_OBJ_RE.search(txt.encode("utf-8"))
+            if m:
+                try:
+                    obj = orjson.loads(m.group(0))
+                    return obj.get("match") is True, str(obj.get("reason") or txt)[:280]
+                except orjson.JSONDecodeError:
+                    pass
             low = txt.lower()
             is_true = "\"match\": true" in low or "match: true" in low or low.startswith("true")
             reason = txt
             return is_true, reason[:280]
         except Exception as e:
-            return False, f"verification_error: {e}"
\ No newline at end of file
+            return False, f"verification_error: {e}"
+
+    def verify_images_batch(self, image_paths: List[str], query: str) -> List[Tuple[bool, str]]:
+        """
+        Verify several candidate images against the request with one model call.
+        Uploads run in parallel threads. Returns one (is_match, brief_reason) per path, in order;
+        falls back to one verify_image_against_query call per image if the answer can't be parsed.
+        """
+        if len(image_paths) <= 1:
+            return [self.verify_image_against_query(p, query) for p in image_paths]
+        try:
+            use_api_key(self._api_key)
+            with ThreadPoolExecutor(max_workers=min(4, len(image_paths))) as ex:
+                handles = list(ex.map(lambda p: genai.upload_file(path=p), image_paths))
+            parts: List[object] = [
+                {"text": (
+                    "You are verifying if images match a user's request. "
+                    "Answer strictly with a JSON array, one object per image in the given order: "
+                    "[{\"match\": true|false, \"reason\": \"...\"}, ...]. "
+                    "Be tolerant of close matches and typical variations. "
+                    "If an image is generic scenery or unrelated, use match:false for it."
+                )},
+            ]
+            for i, handle in enumerate(handles, start=1):
+                parts.append({"text": f"Image {i}:"})
+                parts.append(handle)
+            parts.append({"text": f"User request: {query}"})
+            batch_cfg = genai.GenerationConfig(max_output_tokens=96 * len(image_paths), temperature=0.2)
+            resp = self.model.generate_content(parts, generation_config=batch_cfg)
+            txt = (resp.text or "").strip()
+            m = _VERDICT_ARRAY_RE.search(txt.encode("utf-8"))
+            verdicts = orjson.loads(m.group(0)) if m else None
+            if isinstance(verdicts, list) and len(verdicts) == len(image_paths):
+                out: List[Tuple[bool, str]] = []
+                for v in verdicts:
+                    if isinstance(v, dict):
+                        out.append((v.get("match") is True, str(v.get("reason", ""))[:280]))
+                    else:
+                        out.append((False, str(v)[:280]))
+                return out
+        except Exception:
+            pass
+        return [self.verify_image_against_query(p, query) for p in image_paths]
+
+
+# One responder per process: its model is already cached by build_model, so there is no
+# reason to rebuild the object per message. Replaced when the resolved API key changes.
+_responder: Optional[GeminiResponder] = None
+
+
+def get_responder() -> GeminiResponder:
+    global _responder
+    key = _resolve_api_key()
+    if _responder is None or _responder._api_key != key:
+        _responder = GeminiResponder(api_key=key)
+    return _responder
@@ -1,39 +1,284 @@
+import asyncio
+import functools
 import os
 import mimetypes
+import random
+import time
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 import httpx
+import orjson
 
 from .db import Database
 
+try:
+    import h2  # noqa: F401  # optional; enables HTTP/2 on the shared client
+    _HTTP2 = True
+except Exception:
+    _HTTP2 = False
+
+
+# One pooled client per process for every GreenAPIClient, media downloads and the web/image
+# search fetches: keeps TCP/TLS connections alive between calls instead of a fresh handshake
+# per request. Callers set their own timeouts per request; redirects are followed.
+_shared_client: Optional[httpx.AsyncClient] = None
+# Pool depth follows the job workers (each overlaps several jobs' downloads, uploads and sends),
+# so a busy process reuses warm connections instead of evicting them and handshaking again
+POOL_KEEPALIVE = max(64, int(os.getenv("WORKERS", "2")) * 8)
+
+# Uploads up to this size are read into memory off the event loop; bigger files are streamed.
+UPLOAD_READ_IN_THREAD_MAX = 5 * 1024 * 1024
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+# Pause between empty ReceiveNotification polls: doubles while idle, resets when a notification arrives.
+# Kept small because each second of pause is a second of added reply latency for the next message.
+POLL_IDLE_MIN = 0.1
+POLL_IDLE_MAX = 5.0
+# DeleteNotification acks sent concurrently by the poller's ack task
+DELETE_BATCH = 8
+# Pause before polling again when the queue returns a notification whose ack is still in flight
+ACK_WAIT = 0.05
+# Chunk size when streaming a large upload from disk: each chunk is one worker-thread hop,
+# so keep it large enough that hops don't dominate (memory use stays bounded by it)
+UPLOAD_CHUNK = 1 << 20
+
+# Send endpoints are not idempotent, so only 503 (the request was refused, nothing was sent) is
+# retried, with jittered exponential backoff. A 502/504 from a gateway may come after Green API
+# already accepted the message; retrying it could deliver the message twice.
+RETRY_STATUSES = frozenset({503})
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 10.0
+
+
+def _retry_delay(attempt: int) -> float:
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)) + random.uniform(0, RETRY_BASE_DELAY)
+
+
+class GreenAPIUnavailable(RuntimeError):
+    """Raised without contacting Green API while the send circuit breaker is open."""
+
+
+class _CircuitBreaker:
+    """
+    Opens after fail_max consecutive server-side failures so sends fail fast instead of
+    piling up timeouts; after reset_timeout one trial call is let through (half-open).
+    """
+
+    def __init__(self, fail_max: int = 5, reset_timeout: float = 30.0):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # Half-open: this caller is the trial; others keep failing fast for another window
+            self.opened_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.fail_max:
+            self.opened_at = time.monotonic()
+
+
+_send_breaker = _CircuitBreaker()
+
+
+def get_shared_client() -> httpx.AsyncClient:
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        _shared_client = httpx.AsyncClient(
+            http2=_HTTP2,
+            timeout=httpx.Timeout(65, connect=10),
+            # Media CDNs and image hosts answer with redirects; Green API endpoints never do
+            follow_redirects=True,
+            # Idle connections are kept 15s, long enough to span the poller's idle backoff
+            limits=httpx.Limits(
+                max_keepalive_connections=POOL_KEEPALIVE,
+                max_connections=POOL_KEEPALIVE * 2,
+                keepalive_expiry=15.0,
+            ),
+        )
+    return _shared_client
+
+
+async def close_shared_client() -> None:
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+
+
+def _multipart_envelope(boundary: str, fields: Dict[str, Any], filename: str, ctype: str) -> Tuple[bytes, bytes]:
+    """Bytes before and after the file content in a multipart/form-data body with one file part."""
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+        )
+    safe_name = filename.replace("\\", "\\\\").replace('"', "%22")
+    parts.append(
+        (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{safe_name}"\r\n'
+            f"Content-Type: {ctype}\r\n\r\n"
+        ).encode("utf-8")
+    )
+    return b"".join(parts), f"\r\n--{boundary}--\r\n".encode("ascii")
+
+
+def _open_sequential(file_path: Path):
+    """Open for one front-to-back read and ask the kernel for aggressive readahead where supported."""
+    f = file_path.open("rb")
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    return f
+
+
+async def _stream_multipart(head: bytes, file_path: Path, tail: bytes) -> AsyncIterator[bytes]:
+    yield head
+    f = await asyncio.to_thread(_open_sequential, file_path)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, UPLOAD_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+    yield tail
+
+
+@functools.lru_cache(maxsize=1)
+def _db() -> Database:
+    return Database()
+
+
+# Connection settings read by from_env(), cached briefly so building a client per call stays cheap.
+SETTINGS_TTL = 30.0
+_settings_cache: Tuple[float, Optional[Tuple[str, str, str]]] = (0.0, None)
+
+
+def invalidate_settings_cache() -> None:
+    """Forget cached connection settings (call after they are changed in the WebUI)."""
+    global _settings_cache
+    _settings_cache = (0.0, None)
+
+
+def _connection_settings() -> Tuple[str, str, str]:
+    global _settings_cache
+    now = time.monotonic()
+    expires, cached = _settings_cache
+    if cached is not None and now < expires:
+        return cached
+    # Prefer DB settings if available, fall back to environment variables
+    db = _db()
+    base_url = db.get_setting("GREEN_API_BASE_URL", None) or os.getenv("GREEN_API_BASE_URL", "https://api.green-api.com")
+    id_instance = db.get_setting("GREEN_API_INSTANCE_ID", None) or os.getenv("GREEN_API_INSTANCE_ID", "")
+    api_token = db.get_setting("GREEN_API_API_TOKEN", None) or os.getenv("GREEN_API_API_TOKEN", "")
+    cached = (base_url, id_instance, api_token)
+    _settings_cache = (now + SETTINGS_TTL, cached)
+    return cached
+
+
+class _SendCoalescer:
+    """
+    Merge short text messages to the same chat that arrive within a small window into one
+    sendMessage call (joined with newlines). Callers either await the shared response or,
+    with wait=False, just enqueue (delivery errors are then dropped, as for best-effort notices).
+    """
+
+    def __init__(self, flush_interval: float = 0.1, max_batch: int = 10):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: Dict[str, List[Tuple[str, Optional["asyncio.Future[Dict[str, Any]]"]]]] = {}
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def _spawn(self, coro) -> None:
+        t = asyncio.create_task(coro)
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    async def send(self, client: "GreenAPIClient", chat_id: str, message: str, wait: bool = True) -> Optional[Dict[str, Any]]:
+        fut = asyncio.get_running_loop().create_future() if wait else None
+        items = self._pending.setdefault(chat_id, [])
+        items.append((message, fut))
+        if len(items) == 1:
+            self._spawn(self._flush_later(client, chat_id))
+        elif len(items) >= self.max_batch:
+            self._spawn(self._send(client, chat_id, self._pending.pop(chat_id)))
+        return await fut if fut is not None else None
+
+    async def _flush_later(self, client: "GreenAPIClient", chat_id: str) -> None:
+        await asyncio.sleep(self.flush_interval)
+        items = self._pending.pop(chat_id, None)
+        if items:
+            await self._send(client, chat_id, items)
+
+    async def _send(self, client: "GreenAPIClient", chat_id: str, items: List[Tuple[str, Optional["asyncio.Future[Dict[str, Any]]"]]]) -> None:
+        try:
+            resp = await client.send_message(chat_id=chat_id, message="\n".join(m for m, _ in items))
+        except Exception as e:
+            for _, fut in items:
+                if fut is not None and not fut.done():
+                    fut.set_exception(e)
+            return
+        for _, fut in items:
+            if fut is not None and not fut.done():
+                fut.set_result(resp)
+
+
+_send_coalescer = _SendCoalescer()
+
 
 class GreenAPIClient:
-    def __init__(self, base_url: str, id_instance: str, api_token: str):
+    # Process-wide verdict that this instance's tariff rejects sendImageByUrl with 403
+    # (None = not loaded yet from the GREEN_IMAGE_FORBIDDEN setting).
+    _image_endpoint_forbidden: Optional[bool] = None
+
+    def __init__(self, base_url: str, id_instance: str, api_token: str, http_client: Optional[httpx.AsyncClient] = None):
         self.base_url = base_url.rstrip("/")
         self.media_base_url = "https://media.green-api.com"  # per docs for upload endpoints
         self.id_instance = id_instance
         self.api_token = api_token
+        self._http = http_client
+        # Every endpoint URL is prefix + "/" + method + suffix; build the fixed parts once
+        self._prefix = f"{self.base_url}/waInstance{self.id_instance}"
+        self._suffix = f"/{self.api_token}"
+        self._url_receive = self._url("ReceiveNotification")
+
+    @property
+    def _client(self) -> httpx.AsyncClient:
+        return self._http if self._http is not None else get_shared_client()
 
     @classmethod
     def from_env(cls) -> "GreenAPIClient":
-        # Prefer DB settings if available, fall back to environment variables
-        db = Database()
-        base_url = db.get_setting("GREEN_API_BASE_URL", None) or os.getenv("GREEN_API_BASE_URL", "https://api.green-api.com")
-        id_instance = db.get_setting("GREEN_API_INSTANCE_ID", None) or os.getenv("GREEN_API_INSTANCE_ID", "")
-        api_token = db.get_setting("GREEN_API_API_TOKEN", None) or os.getenv("GREEN_API_API_TOKEN", "")
+        base_url, id_instance, api_token = _connection_settings()
         return cls(base_url=base_url, id_instance=id_instance, api_token=api_token)
 
     def _url(self, path: str) -> str:
-        return f"{self.base_url}/waInstance{self.id_instance}/{path}/{self.api_token}"
+        return f"{self._prefix}/{path}{self._suffix}"
 
     def _url_delete_notification_delete(self, receipt_id: int) -> str:
         # Official: DELETE /waInstance{id}/DeleteNotification/{token}/{receiptId}
-        return f"{self.base_url}/waInstance{self.id_instance}/DeleteNotification/{self.api_token}/{receipt_id}"
+        return f"{self._prefix}/DeleteNotification{self._suffix}/{receipt_id}"
 
     def _url_delete_notification_post(self) -> str:
         # Official: POST /waInstance{id}/DeleteNotification/{token} with {\"receiptId\": ...}
-        return f"{self.base_url}/waInstance{self.id_instance}/DeleteNotification/{self.api_token}"
+        return self._url("DeleteNotification")
 
     def _chat_destination_fields(self, chat_id: Optional[str]) -> Dict[str, str]:
         """
@@ -55,19 +300,75 @@ class GreenAPIClient:
                 out["chatId"] = s
         return out
 
+    async def _post_json(self, url: str, obj: Dict[str, Any], timeout: float) -> httpx.Response:
+        # orjson is several times faster than httpx's stdlib json encoding for these small payloads
+        return await self._client.post(url, content=orjson.dumps(obj), headers=_JSON_HEADERS, timeout=timeout)
+
+    async def _send_json(self, url: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        """
+        POST a send request with retries on 503 and connect errors (both mean nothing was sent),
+        guarded by the shared circuit breaker. Other errors raise as before.
+        """
+        if not _send_breaker.allow():
+            raise GreenAPIUnavailable("Green API circuit open; not sending")
+        attempt = 1
+        while True:
+            try:
+                resp = await self._post_json(url, payload, timeout=timeout)
+            except httpx.ConnectError:
+                if attempt < RETRY_ATTEMPTS:
+                    await asyncio.sleep(_retry_delay(attempt))
+                    attempt += 1
+                    continue
+                _send_breaker.record_failure()
+                raise
+            except httpx.TransportError:
+                _send_breaker.record_failure()
+                raise
+            if resp.status_code in RETRY_STATUSES and attempt < RETRY_ATTEMPTS:
+                await asyncio.sleep(_retry_delay(attempt))
+                attempt += 1
+                continue
+            break
+        if resp.status_code >= 500:
+            _send_breaker.record_failure()
+        else:
+            _send_breaker.record_success()
+        resp.raise_for_status()
+        return orjson.loads(resp.content)
+
+    async def _post_file(self, url: str, file_path: Path, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        POST a file as multipart/form-data. Small files are read in a worker thread so the
+        event loop never blocks on disk; larger ones are streamed disk -> socket in chunks
+        (also read in a worker thread), so memory stays flat regardless of file size.
+        """
+        ctype = mimetypes.guess_type(str(file_path))[0] or "application/octet-stream"
+        size = file_path.stat().st_size
+        if size <= UPLOAD_READ_IN_THREAD_MAX:
+            content = await asyncio.to_thread(file_path.read_bytes)
+            files = {"file": (file_path.name, content, ctype)}
+            resp = await self._client.post(url, data=data, files=files, timeout=300)
+        else:
+            boundary = os.urandom(16).hex()
+            head, tail = _multipart_envelope(boundary, data or {}, file_path.name, ctype)
+            headers = {
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(head) + size + len(tail)),
+            }
+            resp = await self._client.post(
+                url, content=_stream_multipart(head, file_path, tail), headers=headers, timeout=300
+            )
+        resp.raise_for_status()
+        return orjson.loads(resp.content)
+
     async def upload_file(self, file_path: Path) -> Dict[str, Any]:
         """
         Upload any file. Content type is guessed from extension.
         Returns JSON with urlFile, etc.
         """
         url = self._url("uploadFile")
-        ctype = mimetypes.guess_type(str(file_path))[0] or "application/octet-stream"
-        async with httpx.AsyncClient(timeout=300) as client:
-            with file_path.open("rb") as f:
-                files = {"file": (file_path.name, f, ctype)}
-                resp = await client.post(url, files=files)
-            resp.raise_for_status()
-            return resp.json()
+        return await self._post_file(url, file_path)
 
     async def send_file_by_url(self, chat_id: str, url_file: str, filename: str, caption: Optional[str] = None) -> Dict[str, Any]:
         if not url_file:
@@ -80,31 +381,36 @@ class GreenAPIClient:
         payload.update(self._chat_destination_fields(chat_id))
         if caption:
             payload["caption"] = caption
-        async with httpx.AsyncClient(timeout=60) as client:
-            resp = await client.post(url, json=payload)
-            resp.raise_for_status()
-            return resp.json()
+        return await self._send_json(url, payload, timeout=60)
 
     async def send_image_by_url(self, chat_id: str, url_file: str, caption: Optional[str] = None, filename: Optional[str] = None) -> Dict[str, Any]:
         """
         Prefer the dedicated image endpoint so WhatsApp treats the media as an image.
         If the plan/instance forbids sendImageByUrl (403), gracefully fall back to sendFileByUrl.
         """
+        # Ensure we pass a sensible filename with image extension to avoid media misclassification
+        fallback_name = filename or "image.jpg"
+        cls = type(self)
+        if cls._image_endpoint_forbidden is None:
+            cls._image_endpoint_forbidden = _db().get_setting("GREEN_IMAGE_FORBIDDEN", "0") == "1"
+        if cls._image_endpoint_forbidden:
+            # Known 403 on this instance: skip the doomed round-trip
+            return await self.send_file_by_url(chat_id=chat_id, url_file=url_file, filename=fallback_name, caption=caption)
         url = self._url("sendImageByUrl")
         payload: Dict[str, Any] = {"urlFile": url_file}
         payload.update(self._chat_destination_fields(chat_id))
         if caption:
             payload["caption"] = caption
         try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                resp = await client.post(url, json=payload)
-                resp.raise_for_status()
-                return resp.json()
+            return await self._send_json(url, payload, timeout=60)
         except httpx.HTTPStatusError as e:
             # Some Green API tariffs return 403 for sendImageByUrl; use generic file endpoint instead.
             if e.response is not None and e.response.status_code == 403:
-                # Ensure we pass a sensible filename with image extension to avoid media misclassification
-                fallback_name = filename or "image.jpg"
+                cls._image_endpoint_forbidden = True
+                try:
+                    _db().set_setting("GREEN_IMAGE_FORBIDDEN", "1")
+                except Exception:
+                    pass
                 return await self.send_file_by_url(chat_id=chat_id, url_file=url_file, filename=fallback_name, caption=caption)
             raise
 
@@ -119,10 +425,9 @@ class GreenAPIClient:
         payload["idMessage"] = file_id
         if caption:
             payload["caption"] = caption
-        async with httpx.AsyncClient(timeout=60) as client:
-            resp = await client.post(url, json=payload)
-            resp.raise_for_status()
-            return resp.json()
+        resp = await self._post_json(url, payload, timeout=60)
+        resp.raise_for_status()
+        return orjson.loads(resp.content)
 
     async def send_file_by_upload(self, chat_id: str, file_path: Path, caption: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -131,17 +436,11 @@ class GreenAPIClient:
         Endpoint is hosted on media.green-api.com per documentation.
         """
         url = f"{self.media_base_url}/waInstance{self.id_instance}/SendFileByUpload/{self.api_token}"
-        ctype = mimetypes.guess_type(str(file_path))[0] or "application/octet-stream"
         data: Dict[str, Any] = {"fileName": file_path.name}
         data.update(self._chat_destination_fields(chat_id))
         if caption:
             data["caption"] = caption
-        async with httpx.AsyncClient(timeout=300) as client:
-            with file_path.open("rb") as f:
-                files = {"file": (file_path.name, f, ctype)}
-                resp = await client.post(url, data=data, files=files)
-            resp.raise_for_status()
-            return resp.json()
+        return await self._post_file(url, file_path, data=data)
 
     async def send_message(self, chat_id: str, message: str) -> Dict[str, Any]:
         """
@@ -150,29 +449,48 @@ class GreenAPIClient:
         url = self._url("sendMessage")
         payload = {"message": message}
         payload.update(self._chat_destination_fields(chat_id))
-        async with httpx.AsyncClient(timeout=30) as client:
-            resp = await client.post(url, json=payload)
-            resp.raise_for_status()
-            return resp.json()
+        return await self._send_json(url, payload, timeout=30)
+
+    async def send_chat_state(self, chat_id: str, state: str = "typing", duration_ms: int = 5000) -> None:
+        """
+        Best-effort presence hint ("typing" / "recording") shown while a reply is being prepared.
+        Never raises: a missing endpoint on some tariffs must not affect the actual reply.
+        """
+        payload: Dict[str, Any] = {
+            "typingTime": duration_ms,
+            "typingType": "recording" if state == "recording" else "text",
+        }
+        payload.update(self._chat_destination_fields(chat_id))
+        try:
+            await self._post_json(self._url("sendTyping"), payload, timeout=10)
+        except Exception:
+            pass
+
+    async def send_message_batched(self, chat_id: str, message: str, wait: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Like send_message, but texts to the same chat within ~100ms go out as one message.
+        Meant for short status notices that can arrive in bursts. With wait=False the call
+        returns right after queuing (safe to use while holding a lock).
+        """
+        return await _send_coalescer.send(self, chat_id, message, wait=wait)
 
     async def receive_notification(self) -> Optional[Dict[str, Any]]:
         """
         Polls Green API ReceiveNotification for incoming messages and routes them
         through the same handler as the /webhook.
         """
-        url = self._url("ReceiveNotification")
-        async with httpx.AsyncClient(timeout=65) as client:
-            # Green API may use long polling; GET with long timeout
-            resp = await client.get(url)
-            if resp.status_code == 200 and resp.content:
-                data = resp.json()
-                # When no notification, API may return null
-                return data
-            if resp.status_code == 204:
-                return None
-            # On unexpected status, raise to caller
-            resp.raise_for_status()
+        url = self._url_receive
+        # Green API may use long polling; GET with long timeout
+        resp = await self._client.get(url, timeout=65)
+        if resp.status_code == 200 and resp.content:
+            data = orjson.loads(resp.content)
+            # When no notification, API may return null
+            return data
+        if resp.status_code == 204:
             return None
+        # On unexpected status, raise to caller
+        resp.raise_for_status()
+        return None
 
     async def delete_notification(self, receipt_id: int) -> None:
         """
@@ -181,16 +499,113 @@ class GreenAPIClient:
           1) DELETE /.../DeleteNotification/{token}/{receiptId}
           2) POST   /.../DeleteNotification/{token} with JSON {\"receiptId\": ...}
         """
-        async with httpx.AsyncClient(timeout=30) as client:
-            # Variant 1: DELETE with token before receiptId
-            url_delete = self._url_delete_notification_delete(receipt_id)
-            resp = await client.delete(url_delete)
-            if resp.status_code in (200, 204):
-                return
-            # Variant 2: POST with JSON body
-            url_post = self._url_delete_notification_post()
-            resp2 = await client.post(url_post, json={"receiptId": receipt_id})
-            if resp2.status_code in (200, 204):
-                return
-            # If both failed, raise last error
-            resp2.raise_for_status()
+        client = self._client
+        # Variant 1: DELETE with token before receiptId
+        url_delete = self._url_delete_notification_delete(receipt_id)
+        resp = await client.delete(url_delete, timeout=30)
+        if resp.status_code in (200, 204):
+            return
+        # Variant 2: POST with JSON body
+        url_post = self._url_delete_notification_post()
+        resp2 = await self._post_json(url_post, {"receiptId": receipt_id}, timeout=30)
+        if resp2.status_code in (200, 204):
+            return
+        # If both failed, raise last error
+        resp2.raise_for_status()
+
+    async def run_poller(
+        self,
+        handle: Callable[[Dict[str, Any]], Awaitable[Any]],
+        workers: int = 1,
+        on_error: Optional[Callable[[str, BaseException, Any], None]] = None,
+    ) -> None:
+        """
+        Long-poll ReceiveNotification and pass each notification to handle().
+        DeleteNotification acks are queued to a separate task that sends up to DELETE_BATCH
+        at once, so neither the handler nor the next poll waits on an ack round-trip; a
+        notification redelivered before its ack lands is not handled twice. Extra workers
+        poll in parallel on the shared connection pool; keep workers=1 unless duplicate
+        deliveries are acceptable (the queue hands out the same notification until it is deleted).
+        on_error(stage, exc, receipt_id) is called for 'receive_notification',
+        'handle_notification' and 'delete_notification' failures.
+        """
+
+        def _report(stage: str, exc: BaseException, receipt_id: Any) -> None:
+            if on_error is not None:
+                try:
+                    on_error(stage, exc, receipt_id)
+                except Exception:
+                    pass
+
+        delete_q: "asyncio.Queue[int]" = asyncio.Queue()
+        # Receipt ids handed to delete_q whose DeleteNotification hasn't completed yet
+        acks_in_flight: Set[int] = set()
+
+        async def _ack_loop() -> None:
+            while True:
+                batch = [await delete_q.get()]
+                while len(batch) < DELETE_BATCH and not delete_q.empty():
+                    batch.append(delete_q.get_nowait())
+                results = await asyncio.gather(*(self.delete_notification(r) for r in batch), return_exceptions=True)
+                for rid, res in zip(batch, results):
+                    acks_in_flight.discard(rid)
+                    if isinstance(res, asyncio.CancelledError):
+                        raise res
+                    if isinstance(res, BaseException):
+                        _report("delete_notification", res, rid)
+
+        async def _poll_loop() -> None:
+            idle_streak = 0
+            while True:
+                try:
+                    data = await self.receive_notification()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    _report("receive_notification", e, None)
+                    await asyncio.sleep(2.0)
+                    continue
+                if not data:
+                    # A single empty poll is common between bursts, so back off only from the second
+                    # one in a row (0.1s, 0.1s, 0.2s, 0.4s, ... up to POLL_IDLE_MAX); snap back on the next hit
+                    await asyncio.sleep(min(POLL_IDLE_MAX, POLL_IDLE_MIN * 2 ** max(0, idle_streak - 1)))
+                    idle_streak = min(idle_streak + 1, 16)
+                    continue
+                idle_streak = 0
+                receipt_id = data.get("receiptId")
+                if receipt_id is not None:
+                    receipt_id = int(receipt_id)
+                    if receipt_id in acks_in_flight:
+                        # Already handled; the queue keeps returning it until the ack lands
+                        await asyncio.sleep(ACK_WAIT)
+                        continue
+                    acks_in_flight.add(receipt_id)
+                    delete_q.put_nowait(receipt_id)
+                try:
+                    await handle(data)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    _report("handle_notification", e, receipt_id)
+
+        ack_task = asyncio.create_task(_ack_loop())
+        try:
+            await asyncio.gather(*(_poll_loop() for _ in range(max(1, workers))))
+        finally:
+            ack_task.cancel()
+
+
+_green_client: Optional[GreenAPIClient] = None
+
+
+def get_green_client() -> GreenAPIClient:
+    """
+    The process-wide GreenAPIClient on the shared connection pool. Rebuilt only when the
+    connection settings change (e.g. edited in the WebUI), so callers can fetch it per use.
+    """
+    global _green_client
+    base_url, id_instance, api_token = _connection_settings()
+    c = _green_client
+    if c is None or (c.base_url, c.id_instance, c.api_token) != (base_url.rstrip("/"), id_instance, api_token):
+        c = _green_client = GreenAPIClient(base_url=base_url, id_instance=id_instance, api_token=api_token)
+    return c
@@ -1,27 +1,39 @@
 import asyncio
 import json
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import os
 import sys
 import io
 import re
-import random
+import shutil
+import functools
+import heapq
+import itertools
+import time
 import ast
+import multiprocessing
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union, TextIO
+from typing import Any, Dict, List, Optional, Tuple, Union, TextIO
 
 import httpx
+import orjson
 from fastapi import Depends, FastAPI, Request
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
-from urllib.parse import quote_plus, urlparse, parse_qs
+from urllib.parse import quote_plus, urlparse, parse_qs, unquote
 
 from .db import Database, get_db
-from .green_api import GreenAPIClient
-from .pdf_packer import PDFComposer, PDFComposeResult
+from .green_api import GreenAPIClient, close_shared_client, get_green_client, get_shared_client
+from .pdf_packer import PDFComposer, PDFComposeResult, compose_in_process
 from .storage import Storage
-from .tasks import job_queue, workers
+from .tasks import get_batch, job_queue, workers
 
 # Transient store for pending yt-dlp choices per sender
 ytdl_pending: Dict[str, Dict[str, Any]] = {}
@@ -30,9 +42,15 @@ ytdl_pending: Dict[str, Dict[str, Any]] = {}
 suppress_after_pdf: Dict[str, float] = {}  # chat_id -> unix_ts_until
 
 try:
-    from .gemini import GeminiResponder  # optional; only used if enabled
+    from .gemini import GeminiResponder, get_responder  # optional; only used if enabled
 except Exception:
     GeminiResponder = None  # type: ignore
+    get_responder = None  # type: ignore
+
+try:
+    import yt_dlp  # used in-process; the yt-dlp CLI is the fallback when the module is missing
+except Exception:
+    yt_dlp = None  # type: ignore
 
 APP_TITLE = "GreenAPI Image→PDF Relay"
 VERSION = "0.5.0"
@@ -60,33 +78,90 @@ def _utf8_stream_for_stdout() -> TextIO:
 
 _stdout_utf8 = _utf8_stream_for_stdout()
 
+# Naive UTC timestamps serialize as ...Z, matching the previous isoformat() + "Z" output
+_LOG_OPTS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+
+def _json_line(payload: Dict[str, Any]) -> str:
+    """
+    Serialize a json_log payload to an ASCII-only line so Windows consoles with legacy
+    codepages don't crash when messages contain emojis or non-ASCII characters.
+    """
+    line = orjson.dumps(payload, default=str, option=_LOG_OPTS).decode("utf-8")
+    if not line.isascii():
+        # orjson has no ensure_ascii; re-encode the rare non-ASCII line with escapes
+        line = json.dumps(orjson.loads(line), ensure_ascii=True)
+    return line
+
+
+class _JsonLineFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        if isinstance(record.msg, dict):
+            try:
+                return _json_line(record.msg)
+            except Exception:
+                # Last resort: strip any non-ascii that slipped through
+                return str(record.msg).encode("ascii", "ignore").decode("ascii")
+        return super().format(record)
+
+
+def _snapshot(v: Any) -> Any:
+    return v.copy() if isinstance(v, (dict, list, set)) else v
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Hand records to the listener thread unformatted: the stock QueueHandler formats on the
+    calling thread, which is exactly the JSON encoding we want off the event loop. Container
+    values are copied one level deep first, so a caller mutating them after logging can't change
+    the line (or break the listener mid-iteration) before it is written.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.msg, dict):
+            record.msg = {k: _snapshot(v) for k, v in record.msg.items()}
+        if isinstance(record.args, dict):
+            record.args = {k: _snapshot(v) for k, v in record.args.items()}
+        elif record.args:
+            record.args = tuple(_snapshot(a) for a in record.args)
+        return record
+
+
+# Callers only enqueue a record; the listener thread formats it and writes to stdout
+_stdout_handler = logging.StreamHandler(_stdout_utf8)
+_stdout_handler.setFormatter(_JsonLineFormatter("%(message)s"))
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, _stdout_handler)
 logging.basicConfig(
-    level=logging.INFO,
-    format="%(message)s",
-    handlers=[logging.StreamHandler(_stdout_utf8)],
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[_DeferredQueueHandler(_log_queue)],
     force=True,  # override any existing handlers (e.g., added by uvicorn) to enforce UTF-8 stream
 )
+_log_listener.start()
+_root_logger = logging.getLogger()
 
 
 def json_log(event: str, **kwargs):
     """
-    Emit an ASCII-only JSON log line so Windows consoles with legacy codepages don't crash
-    when messages contain emojis or non-ASCII characters.
+    Log one structured event. The JSON line is built and written on the log listener thread.
+    A no-op when LOG_LEVEL is above INFO.
     """
-    payload = {"ts": datetime.utcnow().isoformat() + "Z", "event": event, **kwargs}
-    line = json.dumps(payload, ensure_ascii=True)
+    if not _root_logger.isEnabledFor(logging.INFO):
+        return
+    _root_logger.info({"ts": datetime.utcnow(), "event": event, **kwargs})
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # on_startup / on_shutdown are defined below; they are looked up when the server starts
+    await on_startup()
     try:
-        logging.info(line)
-    except Exception:
-        # Last resort: strip any non-ascii that slipped through
-        try:
-            safe_line = line.encode("ascii", "ignore").decode("ascii")
-            logging.info(safe_line)
-        except Exception:
-            pass
+        yield
+    finally:
+        await on_shutdown()
 
 
-app = FastAPI(title=APP_TITLE, version=VERSION)
+app = FastAPI(title=APP_TITLE, version=VERSION, lifespan=lifespan)
 
 # Static and templates (served by webui)
 static_dir = Path("static")
@@ -97,16 +172,118 @@ app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
 storage = Storage(base=Path("storage"))
 composer = PDFComposer(storage=storage)
 
+
+@dataclass(slots=True)
+class RuntimeConfig:
+    """Environment values read on the job and webhook paths, loaded once per process."""
+    admin_chat_id: str = ""
+    instance_id: str = ""
+    # None when unset; call sites fall back to their own default prompt
+    gemini_system_prompt: Optional[str] = None
+    suppress_gemini_after_pdf_seconds: int = 300
+
+    @classmethod
+    def from_env(cls) -> "RuntimeConfig":
+        return cls(
+            admin_chat_id=os.getenv("ADMIN_CHAT_ID", ""),
+            instance_id=os.getenv("GREEN_API_INSTANCE_ID", ""),
+            gemini_system_prompt=os.getenv("GEMINI_SYSTEM_PROMPT") or None,
+            suppress_gemini_after_pdf_seconds=int(os.getenv("SUPPRESS_GEMINI_AFTER_PDF_SECONDS", "300")),
+        )
+
+
+# Reloaded in on_startup; settings stored in the DB are served by Database.get_setting_cached
+runtime_cfg = RuntimeConfig.from_env()
+
 # Batching state per chat for media -> PDF
 BATCH_WINDOW_SECONDS = int(os.getenv("BATCH_WINDOW_SECONDS", "60"))
+# Open batches (one per sender) held at once; past this, new senders' images are not held
+# for the window but queued right away, so a flood of distinct senders can't grow memory unbounded
+MAX_PENDING_BATCHES = max(1, int(os.getenv("MAX_PENDING_BATCHES", "10000")))
 pending_batches: Dict[str, Dict[str, Any]] = {}
-pending_lock = asyncio.Lock()
+# Per-sender locks guarding pending_batches[sender]; batches of different senders are
+# independent, so they don't queue behind one global lock. Entries are dropped once unused.
+_sender_locks: Dict[str, asyncio.Lock] = {}
+_sender_lock_users: Dict[str, int] = {}
+# Flush timers of pending batches: min-heap of (monotonic deadline, sender, job_id), served by
+# _batch_scheduler; _batch_wakeup tells it a new earliest deadline was added
+_batch_deadlines: List[Tuple[float, str, int]] = []
+_batch_wakeup = asyncio.Event()
+
+# Job worker tasks, the ones currently waiting for work, and the shutdown flag they check
+_job_workers: List["asyncio.Task[None]"] = []
+_idle_job_workers: "set[asyncio.Task[Any]]" = set()
+_draining = asyncio.Event()
+# Seconds on_shutdown waits for in-flight jobs before cancelling them
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "30"))
+
+# Jobs a worker takes from the queue at once when several are waiting
+JOB_BATCH = max(1, int(os.getenv("JOB_BATCH", "8")))
+
+# Media downloads a single job runs at once, and all job workers together, over the shared client
+MAX_DL_PER_JOB = max(1, int(os.getenv("MAX_DL_PER_JOB", "8")))
+_media_dl_sem = asyncio.Semaphore(max(1, int(os.getenv("MAX_DL_TOTAL", "32"))))
+
+# PDF composition (image decode + PDF write) runs here so it doesn't block the event loop.
+# A process pool by default so composition scales past the GIL; PDF_PROCESSES=0 selects
+# a PDF_THREADS-sized thread pool instead (lower memory, e.g. on small instances).
+pdf_pool: Optional[Executor] = None
+pdf_pool_is_process = False
+
+# Strong references to fire-and-forget tasks; the event loop only keeps weak ones
+_bg_tasks: "set[asyncio.Task[Any]]" = set()
+
+
+def _spawn(coro) -> "asyncio.Task[Any]":
+    t = asyncio.create_task(coro)
+    _bg_tasks.add(t)
+    t.add_done_callback(_bg_tasks.discard)
+    return t
+
+
+# Snapshot ids: a counter seeded with the start time in microseconds, written as
+# fixed-width hex so ids stay unique under bursts and still sort chronologically.
+# The pid suffix keeps processes apart when WEB_CONCURRENCY > 1. Also used for temp file names.
+_snapshot_ids = itertools.count(time.time_ns() // 1000)
+_SNAPSHOT_SUFFIX = f"_{os.getpid()}"
+
+# Payload snapshots waiting for _payload_persister, which appends them to the day's JSONL file
+# in batches: one write per batch instead of one file per message. Full queue = snapshot dropped.
+PERSIST_QUEUE_MAX = 10_000
+PERSIST_BATCH = 64
+_persist_queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=PERSIST_QUEUE_MAX)
+
+
+def _queue_payload_snapshot(payload: Dict[str, Any], snapshot_id: str, raw: Optional[bytes] = None) -> None:
+    """
+    Queue one JSONL line for the payload. raw (the webhook request body) is embedded verbatim
+    unless it spans several lines; otherwise the dict is encoded.
+    """
+    body = raw if raw is not None and b"\n" not in raw and b"\r" not in raw else orjson.dumps(payload, default=str)
+    try:
+        _persist_queue.put_nowait(b'{"id":"' + snapshot_id.encode() + b'","payload":' + body + b"}\n")
+    except asyncio.QueueFull:
+        json_log("payload_save_dropped", id=snapshot_id)
+
+
+async def _payload_persister():
+    while True:
+        lines = await get_batch(_persist_queue, PERSIST_BATCH)
+        try:
+            await asyncio.to_thread(storage.append_incoming_payloads, lines)
+        except Exception as e:
+            json_log("payload_save_error", error=str(e), count=len(lines))
 
 # Background queue and worker are defined in app.tasks to avoid circular imports
 
 
-@app.on_event("startup")
 async def on_startup():
+    # Python 3.12+: new tasks run inline until their first await, so fire-and-forget work that
+    # returns early (auto-reply off, duplicate webhook) never costs an event-loop round trip
+    eager_factory = getattr(asyncio, "eager_task_factory", None)
+    if eager_factory is not None:
+        asyncio.get_running_loop().set_task_factory(eager_factory)
+
     # Ensure storage directories exist
     storage.ensure_layout()
 
@@ -115,146 +292,299 @@ async def on_startup():
     db.init()
     json_log("startup", version=VERSION)
 
+    # Conversation state lives in this process's memory; with several processes a follow-up
+    # message can land in another one and be lost (see _PER_PROCESS_STATE)
+    web_concurrency = int(os.getenv("WEB_CONCURRENCY", "1") or "1")
+    if web_concurrency > 1:
+        _root_logger.warning({
+            "ts": datetime.utcnow(),
+            "event": "web_concurrency_per_process_state",
+            "web_concurrency": web_concurrency,
+            "pid": os.getpid(),
+            "affected": _PER_PROCESS_STATE,
+        })
+
+    global pdf_pool, pdf_pool_is_process, runtime_cfg
+    runtime_cfg = RuntimeConfig.from_env()
+    app.state.cfg = runtime_cfg
+    get_green_client()  # build the shared Green API client up front
+    pdf_pool = _make_pdf_pool()
+
+    # Re-enqueue jobs that were still waiting in the queue when the process last stopped
+    # (once, not in every server process)
+    if _acquire_process_lock("job_replay"):
+        _spawn(_replay_pending_jobs(db))
+
     # Launch workers
     worker_count = int(os.getenv("WORKERS", "2"))
     for i in range(worker_count):
-        workers.append(asyncio.create_task(worker_loop(i)))
-
-    # Launch Green API notification poller (for setups without webhooks)
-    workers.append(asyncio.create_task(notification_poller()))
+        t = asyncio.create_task(worker_loop(i))
+        _job_workers.append(t)
+        workers.append(t)
+
+    # Appends payload snapshots to storage/incoming_payloads
+    workers.append(asyncio.create_task(_payload_persister()))
+
+    # One timer task for every pending media batch
+    workers.append(asyncio.create_task(_batch_scheduler()))
+
+    # Launch Green API notification poller (for setups without webhooks).
+    # With several server processes (WEB_CONCURRENCY > 1) only one of them polls.
+    if _acquire_process_lock("poller"):
+        workers.append(asyncio.create_task(notification_poller()))
+    else:
+        json_log("notification_poller_skipped", reason="another_process_polls")
     # Launch QA cleanup loop to purge sessions older than 24h
     workers.append(asyncio.create_task(qa_cleanup_loop()))
+    # Periodically truncate the SQLite WAL once enough job logs have accumulated
+    workers.append(asyncio.create_task(wal_checkpoint_loop()))
 
     # Attach web router after components are ready (import here to avoid circular import)
     from .webui import router as web_router  # local import
     app.include_router(web_router)
 
 
-@app.on_event("shutdown")
 async def on_shutdown():
     json_log("shutdown")
+    # Let job workers finish the jobs they already hold (bounded by SHUTDOWN_GRACE_SECONDS)
+    # instead of cancelling them mid-upload; jobs still queued stay PENDING and are replayed on
+    # the next start. Idle workers and the other background loops are cancelled right away.
+    # uvicorn owns SIGTERM and runs this hook after it stops accepting requests.
+    _draining.set()
+    busy = [w for w in _job_workers if w not in _idle_job_workers and not w.done()]
     for w in workers:
-        w.cancel()
+        if w not in busy:
+            w.cancel()
+    if busy:
+        _, pending = await asyncio.wait(busy, timeout=SHUTDOWN_GRACE_SECONDS)
+        if pending:
+            json_log("shutdown_drain_timeout", unfinished_workers=len(pending))
+            for w in pending:
+                w.cancel()
     await asyncio.gather(*workers, return_exceptions=True)
+    # Write out payload snapshots the persister hadn't picked up yet
+    leftover = []
+    while not _persist_queue.empty():
+        leftover.append(_persist_queue.get_nowait())
+    if leftover:
+        try:
+            storage.append_incoming_payloads(leftover)
+        except Exception as e:
+            json_log("payload_save_error", error=str(e), count=len(leftover))
+    await close_shared_client()
+    if pdf_pool is not None:
+        pdf_pool.shutdown(wait=False, cancel_futures=True)
+    # Flush queued log lines before the process exits
+    _log_listener.stop()
+
+
+# Open lock files held for the life of the process (see _acquire_process_lock)
+_process_locks: Dict[str, Any] = {}
+
+
+def _acquire_process_lock(name: str) -> bool:
+    """
+    Non-blocking exclusive flock on storage/<name>.lock, so exactly one server process runs
+    a singleton loop. The OS drops the lock when the process exits. Without fcntl
+    (Windows, where only a single process is run) the caller always gets it.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    f = open(storage.base / f"{name}.lock", "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _process_locks[name] = f
+    return True
+
+
+def _make_pdf_pool() -> Executor:
+    # Threads by default: each pool process re-imports the app and its image/PDF libraries,
+    # which small hosts can't afford. PDF_PROCESSES > 0 opts into a process pool for CPU-bound hosts.
+    global pdf_pool_is_process
+    procs = int(os.getenv("PDF_PROCESSES", "0"))
+    if procs > 0:
+        pdf_pool_is_process = True
+        # spawn, not fork: this process already runs threads (e.g. the log listener), which fork doesn't copy safely
+        return ProcessPoolExecutor(max_workers=procs, mp_context=multiprocessing.get_context("spawn"))
+    pdf_pool_is_process = False
+    return ThreadPoolExecutor(max_workers=int(os.getenv("PDF_THREADS", "4")), thread_name_prefix="pdf")
+
+
+async def _replay_pending_jobs(db: Database):
+    try:
+        # Only PENDING: PROCESSING is also used by the inline document Q&A jobs, which the
+        # PDF workers must not pick up
+        job_ids = db.get_job_ids_by_status(("PENDING",))
+    except Exception as e:
+        json_log("job_replay_error", error=str(e))
+        return
+    for job_id in job_ids:
+        await job_queue.put(job_id)
+    if job_ids:
+        json_log("jobs_replayed", count=len(job_ids))
 
 
 async def worker_loop(worker_id: int):
     db = Database()
-    client = GreenAPIClient.from_env()
-    async with httpx.AsyncClient(timeout=30) as http_client:
-        while True:
-            try:
-                job_id = await job_queue.get()
-                job = db.get_job(job_id)
-                if not job:
-                    json_log("worker_skip_missing_job", worker_id=worker_id, job_id=job_id)
-                    continue
-                db.update_job_status(job_id, "PROCESSING")
-                json_log("job_processing", worker_id=worker_id, job_id=job_id, msg_id=job["msg_id"])
+    # One connection pool per process, shared by all workers
+    http_client = get_shared_client()
+    me = asyncio.current_task()
+    while not _draining.is_set():
+        # Take whatever is already queued (up to JOB_BATCH) and run those jobs together,
+        # so a burst overlaps its downloads, uploads and sends instead of queueing behind each other
+        _idle_job_workers.add(me)
+        try:
+            batch = await get_batch(job_queue, JOB_BATCH)
+        finally:
+            _idle_job_workers.discard(me)
+        # Fetched per batch so credentials changed in the WebUI apply without a restart
+        client = get_green_client()
+        # dict.fromkeys: a job queued twice (e.g. a resend) runs once per batch
+        await asyncio.gather(*(_process_job(worker_id, job_id, db, client, http_client) for job_id in dict.fromkeys(batch)))
 
-                # Download media
-                media_items = db.get_media_for_job(job_id)
-                downloaded_files = []
-                for m in media_items:
-                    try:
-                        file_path = await storage.download_media(http_client, m["payload"], job)
-                        db.update_media_local_path(m["id"], str(file_path))
-                        downloaded_files.append(file_path)
-                    except Exception as e:
-                        json_log("media_download_error", error=str(e), media=m, job_id=job_id)
-                        raise
-
-                # Look for per-job PDF settings in logs (e.g., images_per_page from "PDF:N" command)
-                try:
-                    logs = db.get_job_logs(job_id)
-                    imgs_per_page = None
-                    for entry in logs:
-                        data = entry.get("entry") or {}
-                        if isinstance(data, dict) and "pdf_images_per_page" in data:
-                            val = data.get("pdf_images_per_page")
-                            try:
-                                imgs_per_page = int(val)
-                            except Exception:
-                                pass
-                    if imgs_per_page:
-                        job["images_per_page"] = imgs_per_page
-                except Exception:
-                    pass
 
-                # Compose PDF
-                try:
-                    pdf_result: PDFComposeResult = composer.compose(job, downloaded_files)
-                    db.update_job_pdf(job_id, pdf_result.pdf_path, pdf_result.meta_path)
-                except Exception as e:
-                    # Inform original sender if allowed, then mark failed
+async def _process_job(worker_id: int, job_id: int, db: Database, client: GreenAPIClient, http_client: httpx.AsyncClient):
+    try:
+        job, media_items = db.load_job_with_media(job_id)
+        if not job:
+            json_log("worker_skip_missing_job", worker_id=worker_id, job_id=job_id)
+            return
+        db.update_job_status(job_id, "PROCESSING")
+        json_log("job_processing", worker_id=worker_id, job_id=job_id, msg_id=job["msg_id"])
+
+        # Download media
+        job_sem = asyncio.Semaphore(MAX_DL_PER_JOB)
+
+        async def _download(m: Dict[str, Any]) -> Path:
+            async with job_sem, _media_dl_sem:
+                return await storage.download_media(http_client, m["payload"], job)
+
+        tasks = [asyncio.create_task(_download(m)) for m in media_items]
+        if tasks:
+            # Fail fast: the first error cancels the job's remaining downloads
+            try:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            except asyncio.CancelledError:
+                for t in tasks:
+                    t.cancel()
+                raise
+            failed = next((t for t in tasks if t.done() and not t.cancelled() and t.exception()), None)
+            if failed is not None:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                exc = failed.exception()
+                json_log("media_download_error", error=str(exc), media=media_items[tasks.index(failed)], job_id=job_id)
+                raise exc
+        downloaded_files = [t.result() for t in tasks]
+        db.update_media_local_paths((m["id"], str(fp)) for m, fp in zip(media_items, downloaded_files))
+
+        # Look for per-job PDF settings in logs (e.g., images_per_page from "PDF:N" command)
+        try:
+            logs = db.get_job_logs(job_id)
+            imgs_per_page = None
+            for entry in logs:
+                data = entry.get("entry") or {}
+                if isinstance(data, dict) and "pdf_images_per_page" in data:
+                    val = data.get("pdf_images_per_page")
                     try:
-                        if _is_sender_allowed(job.get("sender"), db):
-                            await client.send_message(chat_id=(job.get("sender") or ""), message="I couldn't read the image(s) to create a PDF. Please resend clear images.")
+                        imgs_per_page = int(val)
                     except Exception:
                         pass
-                    raise
+            if imgs_per_page:
+                job["images_per_page"] = imgs_per_page
+        except Exception:
+            pass
 
-                # Send the PDF back to the destination chat.
-                # Prefer direct upload-and-send to avoid 400s from sendFileByUrl on some tariffs.
-                dest_chat = os.getenv("ADMIN_CHAT_ID", "") or (job.get("sender") or "")
-                caption = f"PDF from {job['sender']} message {job['msg_id']}"
-                try:
-                    send_resp = await client.send_file_by_upload(
-                        chat_id=dest_chat,
-                        file_path=pdf_result.pdf_path,
-                        caption=caption,
-                    )
-                    # store minimal upload info consistent with previous schema
-                    db.update_job_upload(job_id, {"sentBy": "upload", "file": str(pdf_result.pdf_path)})
-                except Exception:
-                    # Fallback: upload to Green API storage then send by URL
-                    upload = await client.upload_file(pdf_result.pdf_path)
-                    db.update_job_upload(job_id, upload)
-                    send_resp = await client.send_file_by_url(
-                        chat_id=dest_chat,
-                        url_file=upload.get("urlFile", ""),
-                        filename=pdf_result.pdf_path.name,
-                        caption=caption,
-                    )
-                db.update_job_status(job_id, "SENT")
-                db.append_job_log(job_id, {"send": send_resp, "dest_chat": dest_chat})
+        # Compose PDF
+        try:
+            loop = asyncio.get_running_loop()
+            if pdf_pool_is_process:
+                pdf_result: PDFComposeResult = await loop.run_in_executor(
+                    pdf_pool, compose_in_process, str(storage.base), job, [str(p) for p in downloaded_files]
+                )
+            else:
+                pdf_result = await loop.run_in_executor(pdf_pool, composer.compose, job, downloaded_files)
+            db.update_job_pdf(job_id, pdf_result.pdf_path, pdf_result.meta_path)
+        except Exception as e:
+            # Inform original sender if allowed, then mark failed
+            try:
+                if _is_sender_allowed(job.get("sender"), db):
+                    await client.send_message(chat_id=(job.get("sender") or ""), message="I couldn't read the image(s) to create a PDF. Please resend clear images.")
+            except Exception:
+                pass
+            raise
 
-                # Immediately delete source images used for this PDF
-                try:
-                    for fp in downloaded_files:
-                        Path(fp).unlink(missing_ok=True)
-                except Exception:
-                    pass
+        # Send the PDF back to the destination chat.
+        # Prefer direct upload-and-send to avoid 400s from sendFileByUrl on some tariffs.
+        dest_chat = runtime_cfg.admin_chat_id or (job.get("sender") or "")
+        caption = f"PDF from {job['sender']} message {job['msg_id']}"
+        try:
+            send_resp = await client.send_file_by_upload(
+                chat_id=dest_chat,
+                file_path=pdf_result.pdf_path,
+                caption=caption,
+            )
+            # store minimal upload info consistent with previous schema
+            upload_meta = {"sentBy": "upload", "file": str(pdf_result.pdf_path)}
+        except Exception:
+            # Fallback: upload to Green API storage then send by URL
+            upload_meta = await client.upload_file(pdf_result.pdf_path)
+            send_resp = await client.send_file_by_url(
+                chat_id=dest_chat,
+                url_file=upload_meta.get("urlFile", ""),
+                filename=pdf_result.pdf_path.name,
+                caption=caption,
+            )
+        # One commit for the whole completion instead of one per update
+        with db.transaction() as tx:
+            tx.update_job_upload(job_id, upload_meta)
+            tx.update_job_status(job_id, "SENT")
+            tx.append_job_log(job_id, {"send": send_resp, "dest_chat": dest_chat})
 
-                # Schedule deletion of generated PDF and its metadata after 3 hours (10800 seconds)
-                try:
-                    asyncio.create_task(_delete_files_after_delay([pdf_result.pdf_path, pdf_result.meta_path], 10800))
-                except Exception:
-                    pass
+        # Immediately delete source images used for this PDF
+        try:
+            for fp in downloaded_files:
+                Path(fp).unlink(missing_ok=True)
+        except Exception:
+            pass
 
-                # Suppress Gemini replies for a short period after a PDF-from-images job (PDF:N flow)
-                try:
-                    suppress_sec = int(os.getenv("SUPPRESS_GEMINI_AFTER_PDF_SECONDS", "300"))
-                    # If job had 'images_per_page' set from PDF:N, treat as pdf_once job
-                    if (job.get("images_per_page") is not None) and job.get("sender"):
-                        suppress_after_pdf[str(job.get("sender"))] = datetime.utcnow().timestamp() + max(0, suppress_sec)
-                except Exception:
-                    pass
+        # Schedule deletion of generated PDF and its metadata after 3 hours (10800 seconds)
+        try:
+            _spawn(_delete_files_after_delay([pdf_result.pdf_path, pdf_result.meta_path], 10800))
+        except Exception:
+            pass
 
-                json_log("job_sent", worker_id=worker_id, job_id=job_id)
-            except asyncio.CancelledError:
-                raise
-            except Exception as e:
-                # Mark failed and move to quarantine
-                try:
-                    db.update_job_status(job_id, "FAILED")
-                    storage.quarantine_job(job_id)
-                except Exception:
-                    pass
-                json_log("job_failed", worker_id=worker_id, job_id=locals().get("job_id"), error=str(e))
-            finally:
-                if "job_id" in locals():
-                    job_queue.task_done()
+        # Suppress Gemini replies for a short period after a PDF-from-images job (PDF:N flow)
+        try:
+            suppress_sec = runtime_cfg.suppress_gemini_after_pdf_seconds
+            # If job had 'images_per_page' set from PDF:N, treat as pdf_once job
+            if (job.get("images_per_page") is not None) and job.get("sender"):
+                suppress_after_pdf[str(job.get("sender"))] = datetime.utcnow().timestamp() + max(0, suppress_sec)
+        except Exception:
+            pass
+
+        json_log("job_sent", worker_id=worker_id, job_id=job_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # Mark failed and move to quarantine
+        try:
+            db.update_job_status(job_id, "FAILED")
+            storage.quarantine_job(job_id)
+        except Exception:
+            pass
+        # Keep the reason with the job for the WebUI; nothing reads it back, so don't wait on the write
+        try:
+            db.append_job_log_async(job_id, {"error": str(e)})
+        except Exception:
+            pass
+        json_log("job_failed", worker_id=worker_id, job_id=job_id, error=str(e))
 
 
 def _extract_text_from_payload(payload: Dict[str, Any]) -> Optional[str]:
@@ -269,9 +599,11 @@ def _extract_text_from_payload(payload: Dict[str, Any]) -> Optional[str]:
     md = payload.get("messageData") or {}
     if not md:
         return None
+    return _text_from_message_data(md, (md.get("typeMessage") or "").lower())
 
-    t = (md.get("typeMessage") or "").lower()
 
+def _text_from_message_data(md: Dict[str, Any], t: str) -> Optional[str]:
+    """_extract_text_from_payload for an already extracted messageData and lowercased typeMessage."""
     # Standard text
     if t == "textmessage":
         tmd = md.get("textMessageData") or {}
@@ -288,15 +620,58 @@ def _extract_text_from_payload(payload: Dict[str, Any]) -> Optional[str]:
                 return v
 
     # Captions on images/documents
-    for k in ("imageMessageData", "fileMessageData", "documentMessageData"):
-        if k in md:
-            cap = (md.get(k) or {}).get("caption")
+    for k in _CAPTION_KEYS:
+        sub = md.get(k)
+        if sub:
+            cap = sub.get("caption")
             if isinstance(cap, str) and cap.strip():
                 return cap
 
     return None
 
 
+def _media_from_message_data(md: Dict[str, Any], type_message: str) -> List[Dict[str, Any]]:
+    """Media payloads of a messageData: the single-media field(s) for its type plus any 'medias' array."""
+    media_list: List[Dict[str, Any]] = []
+    # Collect known single-media payloads
+    for k in _MEDIA_FIELDS.get(type_message, ()):
+        c = md.get(k)
+        if isinstance(c, dict) and c:
+            media_list.append(c)
+            break
+    else:
+        # Unknown type, or nothing in its usual fields: scan every key, as payloads don't always
+        # put media where their typeMessage suggests
+        for k in _MEDIA_KEYS:
+            c = md.get(k)
+            if isinstance(c, dict) and c:
+                media_list.append(c)
+    # Heuristic: if type mentions 'voice' and we have no explicit payload, treat audioMessageData as voice
+    if ("voice" in type_message or "ptt" in type_message) and not media_list:
+        amd = md.get("audioMessageData")
+        if isinstance(amd, dict) and amd:
+            media_list.append(amd)
+    # Multiple medias array
+    medias = md.get("medias")
+    if isinstance(medias, list):
+        media_list.extend([m for m in medias if isinstance(m, dict)])
+    return media_list
+
+
+def _classify(message_data: Dict[str, Any]) -> Tuple[Optional[str], List[Dict[str, Any]], str]:
+    """
+    One pass over a webhook's messageData: (text or caption, media payloads, lowercased typeMessage).
+    """
+    type_message = str(message_data.get("typeMessage") or "").lower()
+    if not message_data:
+        return None, [], type_message
+    return (
+        _text_from_message_data(message_data, type_message),
+        _media_from_message_data(message_data, type_message),
+        type_message,
+    )
+
+
 # --- Simple, safe math evaluator for common questions (e.g., "2+2", "what is 3^2?", "7 * (8-3)") ---
 
 _ALLOWED_AST_NODES = {
@@ -305,6 +680,21 @@ _ALLOWED_AST_NODES = {
     ast.UAdd, ast.USub, ast.Load, ast.Tuple
 }
 
+# Patterns used on every text message, compiled once
+_IMPLICIT_MUL_BEFORE_PAREN_RE = re.compile(r"(?<=\d)\s*(?=\()")
+_IMPLICIT_MUL_AFTER_PAREN_RE = re.compile(r"(?<=\))\s*(?=\d)")
+_X_MUL_RE = re.compile(r"(?<=\d)\s*[xX]\s*(?=\d)")
+_MATH_ONLY_RE = re.compile(r"[0-9\.\s\+\-\*\/\^\%\(\)xX]+")
+_DIGIT_RE = re.compile(r"\d")
+_WS_RE = re.compile(r"\s+")
+_MATH_OP_RE = re.compile(r"[\+\-\*\/\^\%\)]")
+_MATH_SYMBOL_RE = re.compile(r"[\+\-\*\/\^\%\(\)xX]")
+_FRACTION_RE = re.compile(r"\d+(\.\d+)?\s*/\s*\d+(\.\d+)?")
+_PDF_CMD_RE = re.compile(r"^\s*pdf\s*:\s*(\d+)\s*$", re.IGNORECASE)
+_GOOGLE_IMGRES_RE = re.compile(r'href="/imgres\\?([^"]+)"')
+_IMG_SRC_RE = re.compile(r'<img[^>]+src="(https?://[^"]+)"')
+_DDG_LINK_RE = re.compile(r'<a rel="nofollow" class="result__a" href="([^"]+)"')
+
 def _safe_eval_expr(expr: str) -> Optional[float]:
     """
     Evaluate a math expression safely using AST.
@@ -315,10 +705,10 @@ def _safe_eval_expr(expr: str) -> Optional[float]:
         # Normalize: caret to power
         s = expr.replace("^", "**")
         # Insert implicit multiplication: "2(3+4)" -> "2*(3+4)" and "(2+3)4" -> "(2+3)*4"
-        s = re.sub(r"(?<=\d)\s*(?=\()", "*", s)
-        s = re.sub(r"(?<=\))\s*(?=\d)", "*", s)
+        s = _IMPLICIT_MUL_BEFORE_PAREN_RE.sub("*", s)
+        s = _IMPLICIT_MUL_AFTER_PAREN_RE.sub("*", s)
         # Handle simple 'x' between numbers as multiply: 2x3 -> 2*3
-        s = re.sub(r"(?<=\d)\s*[xX]\s*(?=\d)", "*", s)
+        s = _X_MUL_RE.sub("*", s)
         # Parse
         node = ast.parse(s, mode="eval")
         # Validate nodes
@@ -374,7 +764,7 @@ def _maybe_answer_math_text(txt: str) -> Optional[str]:
     low = s.lower()
 
     # Heuristic: if string contains only math characters (plus some spaces), treat as expression
-    if re.fullmatch(r"[0-9\.\s\+\-\*\/\^\%\(\)xX]+", s):
+    if _MATH_ONLY_RE.fullmatch(s):
         val = _safe_eval_expr(s)
         if val is not None:
             # Beautify: show as int if close
@@ -384,12 +774,12 @@ def _maybe_answer_math_text(txt: str) -> Optional[str]:
         return None
 
     # Otherwise, try to extract the math expression from common phrasings
-    if any(w in low for w in _MATH_TRIGGER_WORDS) or re.search(r"\d", s):
+    if any(w in low for w in _MATH_TRIGGER_WORDS) or _DIGIT_RE.search(s):
         # Keep only math-relevant characters
         expr = "".join(ch for ch in s if ch in "0123456789.+-*/%^()xX ")
-        expr = re.sub(r"\s+", "", expr)
+        expr = _WS_RE.sub("", expr)
         # Require at least one operator
-        if re.search(r"[\+\-\*\/\^\%\)]", expr):
+        if _MATH_OP_RE.search(expr):
             val = _safe_eval_expr(expr)
             if val is not None:
                 if abs(val - round(val)) < 1e-12:
@@ -405,63 +795,130 @@ def _looks_like_math_intent(txt: str) -> bool:
     # explicit triggers or contains digits with at least one operator/symbol
     if any(w in low for w in _MATH_TRIGGER_WORDS):
         return True
-    if re.search(r"\d", s) and re.search(r"[\+\-\*\/\^\%\(\)xX]", s):
+    if _DIGIT_RE.search(s) and _MATH_SYMBOL_RE.search(s):
         return True
     # simple fraction or decimal patterns
-    if re.fullmatch(r"\d+(\.\d+)?\s*/\s*\d+(\.\d+)?", s):
+    if _FRACTION_RE.fullmatch(s):
         return True
     return False
 
 
+_UTC = timezone.utc
+_fromtimestamp = datetime.fromtimestamp
+
+
+def _to_utc(v: Any) -> Optional[datetime]:
+    """Convert an epoch value (seconds or ms; int, float or digit string) to UTC."""
+    t = type(v)
+    if t is int:
+        sec = v
+    elif t is str:
+        if not v.isdigit():
+            return None
+        sec = int(v)
+    elif t is float:
+        sec = v
+    else:
+        return None
+    # treat values that look like ms; integer ms stay integers (the window check needs no sub-second precision)
+    if sec > 1_000_000_000_000:
+        sec = sec // 1000 if type(sec) is int else sec / 1000.0
+    try:
+        return _fromtimestamp(sec, tz=_UTC)
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
 def _extract_event_time(payload: Dict[str, Any]) -> Optional[datetime]:
     """
     Try to get the message event time as UTC datetime.
-    Looks for common Green API fields: 'timestamp' (epoch seconds).
+    Looks for common Green API fields: 'timestamp' (epoch seconds), then 'sendTime',
+    at the top level and under messageData; the first usable one wins.
     """
-    candidates: List[Optional[Union[int, float, str]]] = []
-    # top-level
-    candidates.append(payload.get("timestamp"))
-    # typical locations
+    v = payload.get("timestamp")
+    if v is not None:
+        evt = _to_utc(v)
+        if evt is not None:
+            return evt
     md = payload.get("messageData") or {}
-    candidates.append(md.get("timestamp"))
+    v = md.get("timestamp")
+    if v is not None:
+        evt = _to_utc(v)
+        if evt is not None:
+            return evt
     # sometimes stored under 'sendTime' or similar
-    candidates.append(payload.get("sendTime"))
-    candidates.append(md.get("sendTime"))
-    # process
-    for c in candidates:
-        if c is None:
-            continue
-        try:
-            # parse numeric epoch seconds
-            if isinstance(c, (int, float)) or (isinstance(c, str) and c.isdigit()):
-                sec = float(c)
-                # treat values that look like ms
-                if sec > 1e12:
-                    sec = sec / 1000.0
-                return datetime.fromtimestamp(sec, tz=timezone.utc)
-        except Exception:
-            continue
+    v = payload.get("sendTime")
+    if v is not None:
+        evt = _to_utc(v)
+        if evt is not None:
+            return evt
+    v = md.get("sendTime")
+    if v is not None:
+        return _to_utc(v)
     return None
 
 
 WINDOW_SECONDS = 180  # 3 minutes
+WINDOW_DELTA = timedelta(seconds=WINDOW_SECONDS)
+
+# Webhook constants, built once instead of per request
+_INCOMING_WEBHOOK_TYPES = frozenset({"incomingmessagereceived"})
+# Single-media payload keys, in the order they are collected
+_MEDIA_KEYS = (
+    "imageMessageData",
+    "videoMessageData",
+    "fileMessageData",
+    "documentMessageData",
+    "audioMessageData",
+    "voiceMessageData",  # some providers use this for PTT/voice notes
+)
+# typeMessage (lowercased) -> media fields to probe first, most specific first; Green API puts most
+# media under fileMessageData. When none of them holds media (or the type isn't listed), all of
+# _MEDIA_KEYS is scanned, so any payload shape accepted before is still accepted.
+_MEDIA_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "imagemessage": ("imageMessageData", "fileMessageData"),
+    "videomessage": ("videoMessageData", "fileMessageData"),
+    "documentmessage": ("documentMessageData", "fileMessageData"),
+    "audiomessage": ("audioMessageData", "fileMessageData"),
+}
+_IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff", ".bmp")
+
+
+def _is_image_media(m: Dict[str, Any]) -> bool:
+    mt = (m.get("mimeType") or m.get("mimetype") or "").lower()
+    if mt.startswith("image/"):
+        return True
+    return (m.get("fileName") or m.get("caption") or "").lower().endswith(_IMAGE_EXTS)
+
+
+# Text command words, matched against the stripped, lowercased message
+_GREETING_WORDS = ("hi", "hello", "hey", "good morning", "good afternoon", "good evening")
+_ADDITION_WORDS = frozenset({"addition", "add"})
+_YTDL_CANCEL_WORDS = frozenset({"cancel", "stop", "no"})
+_YTDL_CONFIRM_WORDS = frozenset({"yes", "y", "download", "ok"})
+_QA_STOP_WORDS = frozenset({"stop", "exit", "quit"})
+# Document Q&A session commands, matched once against the stripped message:
+# group 1 = a bare command, group 2 + 3 = "use <id>" / "delete <id>"
+_QA_COMMAND_RE = re.compile(r"(stop|exit|quit|list)|(use|delete) (.+)", re.IGNORECASE | re.DOTALL)
+# Media payloads that may carry a caption
+_CAPTION_KEYS = ("imageMessageData", "fileMessageData", "documentMessageData")
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_number_list(raw: str) -> "frozenset[str]":
+    """ALLOW_NUMBERS / BLOCK_NUMBERS setting (comma or newline separated) as a set; memoized on the raw string."""
+    return frozenset(p.strip() for p in raw.replace("\n", ",").split(",") if p.strip())
 
 
 def _is_sender_allowed(chat_id: Optional[str], db: Database) -> bool:
     if not chat_id:
         return False
-    mode = (db.get_setting("REPLY_MODE", "everyone") or "everyone").lower()
-    allow_raw = db.get_setting("ALLOW_NUMBERS", "") or ""
-    block_raw = db.get_setting("BLOCK_NUMBERS", "") or ""
-    def parse_list(s: str) -> List[str]:
-        parts = [p.strip() for p in s.replace("\n", ",").split(",") if p.strip()]
-        return [p for p in parts]
-    allows = set(parse_list(allow_raw))
-    blocks = set(parse_list(block_raw))
+    mode = (db.get_setting_cached("REPLY_MODE", "everyone") or "everyone").lower()
+    # Only the list the mode uses is read; settings come from the TTL cache, parsing from _parse_number_list
     if mode == "allowlist":
-        return chat_id in allows
+        return chat_id in _parse_number_list(db.get_setting_cached("ALLOW_NUMBERS", "") or "")
     if mode == "blocklist":
-        return chat_id not in blocks
+        return chat_id not in _parse_number_list(db.get_setting_cached("BLOCK_NUMBERS", "") or "")
     return True  # everyone
 
 def _is_suppressed_from_gemini(chat_id: Optional[str]) -> bool:
@@ -475,23 +932,61 @@ def _is_suppressed_from_gemini(chat_id: Optional[str]) -> bool:
     except Exception:
         return False
 
-async def maybe_auto_reply(payload: Dict[str, Any], db: Database):
+# Gemini replies generated at once, and chats that already have an auto-reply on the way
+AUTO_REPLY_CONCURRENCY = max(1, int(os.getenv("AUTO_REPLY_CONCURRENCY", "8")))
+_reply_sem = asyncio.Semaphore(AUTO_REPLY_CONCURRENCY)
+_auto_reply_in_flight: "set[str]" = set()
+
+
+async def maybe_auto_reply(
+    payload: Dict[str, Any],
+    db: Database,
+    *,
+    text: Optional[str] = None,
+    chat_id: Optional[str] = None,
+    auto_enabled: Optional[bool] = None,
+):
     """
     Send a single concise auto-reply (no duplicates, no secondary variants).
+    Safe to fire and forget via _spawn: a chat with a reply still in flight is skipped,
+    and at most AUTO_REPLY_CONCURRENCY replies are generated at once.
+    Callers that already know the message text, chat id or the auto_reply_enabled switch
+    pass them in; anything left as None is derived from the payload / settings here.
     """
-    chat_id = payload.get("senderData", {}).get("chatId")
+    # Cheap global switch first: no per-chat work at all while auto-reply is off
+    if auto_enabled is None:
+        auto_enabled = (db.get_setting_cached("auto_reply_enabled", "0") or "0") == "1"
+    if not auto_enabled:
+        return
+    if chat_id is None:
+        chat_id = (payload.get("senderData") or {}).get("chatId")
     if not chat_id:
         return
+    if text is None:
+        text = _extract_text_from_payload(payload)
+    if not text:
+        return
+    if chat_id in _auto_reply_in_flight:
+        json_log("auto_reply_skipped", reason="in_flight", chat_id=chat_id)
+        return
+    _auto_reply_in_flight.add(chat_id)
+    try:
+        async with _reply_sem:
+            await _auto_reply(db, chat_id, text)
+    finally:
+        _auto_reply_in_flight.discard(chat_id)
+
+
+async def _auto_reply(db: Database, chat_id: str, text: str):
     if not _is_sender_allowed(chat_id, db):
         return
     if _is_suppressed_from_gemini(chat_id):
         return
-    text = _extract_text_from_payload(payload)
-    if not text:
-        return
 
-    base_system = db.get_setting("auto_reply_system_prompt", "") or os.getenv(
-        "GEMINI_SYSTEM_PROMPT", "You are a concise helpful WhatsApp assistant."
+    base_system = (
+        db.get_setting_cached("auto_reply_system_prompt", "")
+        or runtime_cfg.gemini_system_prompt
+        or "You are a concise helpful WhatsApp assistant."
     )
 
     if GeminiResponder is None:
@@ -499,8 +994,8 @@ async def maybe_auto_reply(payload: Dict[str, Any], db: Database):
         return
 
     try:
-        client = GreenAPIClient.from_env()
-        responder = GeminiResponder()
+        client = get_green_client()
+        responder = get_responder()
         prompt = f"{base_system}\nRespond in one short sentence. Plain text only."
         reply = await asyncio.to_thread(responder.generate, text, prompt, chat_id)
         await client.send_message(chat_id=chat_id, message=reply)
@@ -522,14 +1017,66 @@ async def _delete_files_after_delay(paths: List[Path], delay_seconds: int):
     except Exception:
         pass
 
-async def _enqueue_batch_later(sender: str, db: Database):
+@asynccontextmanager
+async def _batch_lock(sender: str):
+    lock = _sender_locks.get(sender)
+    if lock is None:
+        lock = _sender_locks[sender] = asyncio.Lock()
+    _sender_lock_users[sender] = _sender_lock_users.get(sender, 0) + 1
     try:
-        await asyncio.sleep(BATCH_WINDOW_SECONDS)
-        async with pending_lock:
+        async with lock:
+            yield
+    finally:
+        n = _sender_lock_users[sender] - 1
+        if n:
+            _sender_lock_users[sender] = n
+        else:
+            del _sender_lock_users[sender]
+            del _sender_locks[sender]
+
+
+def _schedule_batch_flush(sender: str, batch: Dict[str, Any], delay: float) -> None:
+    """
+    Arm the flush timer of a pending batch. All batches share the one _batch_scheduler task
+    instead of a sleeping task per sender. Call with the sender's _batch_lock held.
+    """
+    deadline = time.monotonic() + delay
+    batch["deadline"] = deadline
+    heapq.heappush(_batch_deadlines, (deadline, sender, batch["job_id"]))
+    if _batch_deadlines[0][0] == deadline:
+        # New earliest deadline: make the scheduler recompute its sleep
+        _batch_wakeup.set()
+
+
+async def _batch_scheduler():
+    db = Database()
+    while True:
+        timeout = (_batch_deadlines[0][0] - time.monotonic()) if _batch_deadlines else None
+        if timeout is None or timeout > 0:
+            try:
+                await asyncio.wait_for(_batch_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        _batch_wakeup.clear()
+        now = time.monotonic()
+        while _batch_deadlines and _batch_deadlines[0][0] <= now:
+            deadline, sender, job_id = heapq.heappop(_batch_deadlines)
+            b = pending_batches.get(sender)
+            # Entries of batches that were replaced or cancelled since are simply dropped here
+            if not b or b.get("job_id") != job_id or b.get("deadline") != deadline:
+                continue
+            if b.get("mode") == "pdf_once":
+                _spawn(_flush_pdf_once(sender, job_id, db))
+            else:
+                _spawn(_flush_batch(sender, job_id, db))
+
+
+async def _flush_batch(sender: str, job_id: int, db: Database):
+    try:
+        async with _batch_lock(sender):
             b = pending_batches.get(sender)
-            if not b:
+            if not b or b.get("job_id") != job_id:
                 return
-            job_id = b["job_id"]
             # Move to queue only if still pending
             db.update_job_status(job_id, "PENDING")
             await job_queue.put(job_id)
@@ -537,20 +1084,18 @@ async def _enqueue_batch_later(sender: str, db: Database):
             # Remove batch
             pending_batches.pop(sender, None)
     except asyncio.CancelledError:
-        # Batch was cancelled due to new batch or shutdown
+        # Shutdown
         raise
     except Exception as e:
         json_log("batch_enqueue_error", sender=sender, error=str(e))
 
-async def _enqueue_pdf_once_later(sender: str, db: Database, window: int = 60):
-    client = GreenAPIClient.from_env()
+async def _flush_pdf_once(sender: str, job_id: int, db: Database):
+    client = get_green_client()
     try:
-        await asyncio.sleep(window)
-        async with pending_lock:
+        async with _batch_lock(sender):
             b = pending_batches.get(sender)
-            if not b or b.get("mode") != "pdf_once":
+            if not b or b.get("mode") != "pdf_once" or b.get("job_id") != job_id:
                 return
-            job_id = b["job_id"]
             # Notify time over
             try:
                 if _is_sender_allowed(sender, db):
@@ -598,6 +1143,42 @@ def _normalize_youtube_url(url: str) -> str:
         return url
 
 
+async def _run_subprocess(*args: str, timeout: Optional[float] = None) -> Tuple[Optional[int], bytes, bytes]:
+    """
+    Run an external tool (yt-dlp, ffmpeg) and collect its output without blocking the loop.
+    On timeout the process is killed and reaped, and returncode is None.
+    """
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        return None, b"", b"timed out"
+    return proc.returncode, stdout, stderr
+
+
+# In-process equivalents of the CLI flags used below: --no-playlist, --force-ipv4,
+# --extractor-args youtube:player_client=android
+_YTDL_BASE_OPTS: Dict[str, Any] = {
+    "noplaylist": True,
+    "source_address": "0.0.0.0",
+    "extractor_args": {"youtube": {"player_client": ["android"]}},
+    "quiet": True,
+    "no_warnings": True,
+    "noprogress": True,
+}
+
+
+def _ytdl_extract(url: str, opts: Dict[str, Any], download: bool) -> Dict[str, Any]:
+    """Run yt_dlp in the calling thread (call via asyncio.to_thread); returns the JSON-safe info dict."""
+    with yt_dlp.YoutubeDL({**_YTDL_BASE_OPTS, **opts}) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=download))
+
+
 async def _ytdl_prepare_choices(url: str) -> List[Dict[str, Any]]:
     """
     Inspect available formats with yt-dlp -J and pick reasonable 480p and 720p progressive formats.
@@ -605,19 +1186,23 @@ async def _ytdl_prepare_choices(url: str) -> List[Dict[str, Any]]:
     """
     try:
         norm_url = _normalize_youtube_url(url)
-        proc = await asyncio.create_subprocess_exec(
-            "yt-dlp", "-J", "--no-playlist", "--force-ipv4",
-            "--extractor-args", "youtube:player_client=android",
-            norm_url,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, stderr = await proc.communicate()
-        if proc.returncode != 0:
-            json_log("ytdl_probe_error", url=norm_url, stderr=stderr.decode("utf-8", "ignore")[:200])
-            return []
-        import json as _json
-        info = _json.loads(stdout.decode("utf-8", "ignore") or "{}")
+        if yt_dlp is not None:
+            try:
+                info = await asyncio.wait_for(asyncio.to_thread(_ytdl_extract, norm_url, {}, False), timeout=120)
+            except Exception as e:
+                json_log("ytdl_probe_error", url=norm_url, stderr=str(e)[:200])
+                return []
+        else:
+            returncode, stdout, stderr = await _run_subprocess(
+                "yt-dlp", "-J", "--no-playlist", "--force-ipv4",
+                "--extractor-args", "youtube:player_client=android",
+                norm_url,
+                timeout=120,
+            )
+            if returncode != 0:
+                json_log("ytdl_probe_error", url=norm_url, stderr=stderr.decode("utf-8", "ignore")[:200])
+                return []
+            info = orjson.loads(stdout or b"{}")
         formats = info.get("formats") or []
         duration = info.get("duration") or None  # seconds
 
@@ -689,16 +1274,13 @@ async def _google_images_candidates(query: str) -> List[str]:
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124 Safari/537.36",
             "Accept-Language": "en-US,en;q=0.9",
         }
-        async with httpx.AsyncClient(timeout=20, follow_redirects=True) as hc:
-            r = await hc.get(url, headers=headers)
-            if r.status_code != 200:
-                return []
-            html = r.text
+        r = await get_shared_client().get(url, headers=headers, timeout=20)
+        if r.status_code != 200:
+            return []
+        html = r.text
 
         # Strategy 1: extract from /imgres?imgurl=... links
-        import re
-        from urllib.parse import unquote, urlparse, parse_qs
-        hrefs = re.findall(r'href="/imgres\\?([^"]+)"', html)
+        hrefs = _GOOGLE_IMGRES_RE.findall(html)
         urls: List[str] = []
         for h in hrefs:
             qs = parse_qs(h)
@@ -711,7 +1293,7 @@ async def _google_images_candidates(query: str) -> List[str]:
 
         # Strategy 2: fallback to direct img src attributes (thumbnails often, but sometimes originals)
         if not urls:
-            srcs = re.findall(r'<img[^>]+src="(https?://[^"]+)"', html)
+            srcs = _IMG_SRC_RE.findall(html)
             urls = [s for s in srcs if s.lower().startswith("http") and "gstatic" not in s.lower()]
 
         # Dedup and limit
@@ -745,11 +1327,12 @@ async def _wiki_image_candidates(query: str) -> List[str]:
             "format": "json",
             "origin": "*",
         }
-        async with httpx.AsyncClient(timeout=20) as hc:
-            r = await hc.get("https://commons.wikimedia.org/w/api.php", params=params, headers={"User-Agent": "RelayBot/1.0"})
-            if r.status_code != 200:
-                return []
-            data = r.json()
+        r = await get_shared_client().get(
+            "https://commons.wikimedia.org/w/api.php", params=params, headers={"User-Agent": "RelayBot/1.0"}, timeout=20
+        )
+        if r.status_code != 200:
+            return []
+        data = r.json()
         pages = (data.get("query") or {}).get("pages") or {}
         urls: List[str] = []
         for _, p in pages.items():
@@ -763,6 +1346,11 @@ async def _wiki_image_candidates(query: str) -> List[str]:
     except Exception:
         return []
 
+
+# Image-search candidates fetched and verified per Gemini call
+IMAGE_VERIFY_BATCH = 3
+
+
 async def _search_verify_send_image(sender: str, query: str, prefer_ext: str, db: Database) -> bool:
     """
     Search for an image, download the best candidate, verify it with Gemini, then send.
@@ -771,7 +1359,7 @@ async def _search_verify_send_image(sender: str, query: str, prefer_ext: str, db
     - Avoid TIFF/SVG/HEIC and other unsupported formats before sending.
     Sends a short 'please wait' message to the user up-front.
     """
-    client = GreenAPIClient.from_env()
+    client = get_green_client()
     # Avoid sending a preliminary message to prevent duplicate-looking replies.
 
     tmp_dir = storage.base / "tmp"
@@ -782,7 +1370,7 @@ async def _search_verify_send_image(sender: str, query: str, prefer_ext: str, db
     # Try sharpening the query with Gemini
     try:
         if GeminiResponder is not None:
-            gr = GeminiResponder()
+            gr = get_responder()
             query = await asyncio.to_thread(gr.rewrite_search_query, query)
     except Exception:
         pass
@@ -855,79 +1443,94 @@ async def _search_verify_send_image(sender: str, query: str, prefer_ext: str, db
         "image/x-icon", "image/vnd.microsoft.icon",
     }
 
-    for idx, url in enumerate(candidates, start=1):
+    def _cleanup(bin_path: Path, out_proc: Path) -> None:
+        try:
+            bin_path.unlink(missing_ok=True)
+            if out_proc != bin_path:
+                out_proc.unlink(missing_ok=True)
+        except Exception:
+            pass
+
+    async def _fetch_candidate(idx: int, url: str) -> Optional[Tuple[Path, Path]]:
+        """Download one candidate and re-encode it; returns (downloaded, re-encoded) paths or None."""
         # Use a neutral temporary name first; we'll re-encode to final extension later
-        tmp_name = f"img_{int(datetime.utcnow().timestamp())}_{random.randint(1000,9999)}_{idx}.bin"
+        tmp_name = f"img_{next(_snapshot_ids):016x}{_SNAPSHOT_SUFFIX}_{idx}.bin"
         bin_path = tmp_dir / tmp_name
         try:
-            async with httpx.AsyncClient(timeout=30, follow_redirects=True) as hc:
-                r = await hc.get(url, headers={"User-Agent": "Mozilla/5.0"})
-                if r.status_code != 200 or not r.content:
-                    json_log("image_candidate_fetch_failed", url=url, status=r.status_code)
-                    continue
-                ct = (r.headers.get("Content-Type") or "").split(";")[0].strip().lower()
-                json_log("image_candidate_content_type", url=url, content_type=ct or "unknown", size=len(r.content))
-                # Skip obvious non-image or unsupported types before writing
-                if not any(ct.startswith(p) for p in acceptable_ct_prefix) or ct in unacceptable_ct:
-                    json_log("image_candidate_skipped", url=url, content_type=ct or "unknown")
-                    continue
-                with bin_path.open("wb") as f:
-                    f.write(r.content)
+            r = await get_shared_client().get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=30)
+            if r.status_code != 200 or not r.content:
+                json_log("image_candidate_fetch_failed", url=url, status=r.status_code)
+                return None
+            ct = (r.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            json_log("image_candidate_content_type", url=url, content_type=ct or "unknown", size=len(r.content))
+            # Skip obvious non-image or unsupported types before writing
+            if not any(ct.startswith(p) for p in acceptable_ct_prefix) or ct in unacceptable_ct:
+                json_log("image_candidate_skipped", url=url, content_type=ct or "unknown")
+                return None
+            with bin_path.open("wb") as f:
+                f.write(r.content)
 
             # Always re-encode to supported format/size
-            out_proc = _reencode_supported(bin_path, prefer=prefer_ext_norm)
-
-            # Verify with Gemini if available
-            verified = True
-            reason = "ok"
-            if GeminiResponder is not None:
-                try:
-                    gr = GeminiResponder()
-                    verified, reason = await asyncio.to_thread(gr.verify_image_against_query, str(out_proc), query)
-                except Exception as e:
-                    # If verification fails due to model issues, don't block sending a valid image
-                    verified = True
-                    reason = f"verify_error_ignored: {e}"
-
-            if not verified:
-                json_log("image_candidate_rejected", url=url, reason=reason)
-                try:
-                    bin_path.unlink(missing_ok=True)
-                    if out_proc != bin_path:
-                        out_proc.unlink(missing_ok=True)
-                except Exception:
-                    pass
-                continue
-
-            # Prefer direct upload-and-send to ensure WhatsApp treats it as an image and avoid URL/plan issues.
-            if _is_sender_allowed(sender, db):
-                cap = f"Image for: {query}"
-                try:
-                    await client.send_file_by_upload(chat_id=sender, file_path=out_proc, caption=cap)
-                except Exception:
-                    # Fallback: upload to Green API storage then send by image endpoint (with internal fallback to file)
-                    up = await client.upload_file(out_proc)
-                    await client.send_image_by_url(
-                        chat_id=sender,
-                        url_file=up.get("urlFile", ""),
-                        caption=cap,
-                        filename=out_proc.name,
-                    )
-            try:
-                bin_path.unlink(missing_ok=True)
-                if out_proc != bin_path:
-                    out_proc.unlink(missing_ok=True)
-            except Exception:
-                pass
-            return True
+            return bin_path, _reencode_supported(bin_path, prefer=prefer_ext_norm)
         except Exception as e:
             json_log("image_fetch_error", error=str(e), query=query, source=url)
             try:
                 bin_path.unlink(missing_ok=True)
             except Exception:
                 pass
+            return None
+
+    # Candidates are fetched and verified a few at a time: one Gemini call judges the whole chunk
+    for first in range(0, len(candidates), IMAGE_VERIFY_BATCH):
+        batch: List[Tuple[str, Path, Path]] = []
+        for idx, url in enumerate(candidates[first:first + IMAGE_VERIFY_BATCH], start=first + 1):
+            fetched = await _fetch_candidate(idx, url)
+            if fetched:
+                batch.append((url, fetched[0], fetched[1]))
+        if not batch:
             continue
 
+        # Verify with Gemini if available
+        verdicts: List[Tuple[bool, str]] = [(True, "ok")] * len(batch)
+        if GeminiResponder is not None:
+            try:
+                gr = get_responder()
+                verdicts = await asyncio.to_thread(gr.verify_images_batch, [str(b[2]) for b in batch], query)
+            except Exception as e:
+                # If verification fails due to model issues, don't block sending a valid image
+                verdicts = [(True, f"verify_error_ignored: {e}")] * len(batch)
+
+        sent = False
+        for (url, bin_path, out_proc), (verified, reason) in zip(batch, verdicts):
+            if sent:
+                _cleanup(bin_path, out_proc)
+                continue
+            if not verified:
+                json_log("image_candidate_rejected", url=url, reason=reason)
+                _cleanup(bin_path, out_proc)
+                continue
+            try:
+                # Prefer direct upload-and-send to ensure WhatsApp treats it as an image and avoid URL/plan issues.
+                if _is_sender_allowed(sender, db):
+                    cap = f"Image for: {query}"
+                    try:
+                        await client.send_file_by_upload(chat_id=sender, file_path=out_proc, caption=cap)
+                    except Exception:
+                        # Fallback: upload to Green API storage then send by image endpoint (with internal fallback to file)
+                        up = await client.upload_file(out_proc)
+                        await client.send_image_by_url(
+                            chat_id=sender,
+                            url_file=up.get("urlFile", ""),
+                            caption=cap,
+                            filename=out_proc.name,
+                        )
+                sent = True
+            except Exception as e:
+                json_log("image_fetch_error", error=str(e), query=query, source=url)
+            _cleanup(bin_path, out_proc)
+        if sent:
+            return True
+
     # If none verified/sent
     if _is_sender_allowed(sender, db):
         try:
@@ -937,83 +1540,71 @@ async def _search_verify_send_image(sender: str, query: str, prefer_ext: str, db
     return False
 
 
-async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict[str, Any]:
-    # Persist raw payload
-    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")
-    storage.save_incoming_payload(payload, f"{ts}.json")
+async def handle_incoming_payload(payload: Dict[str, Any], db: Database, raw: Optional[bytes] = None) -> Dict[str, Any]:
+    # Raw payloads are queued for the background persister (nothing on this path reads them back),
+    # except redeliveries of a message already handled and messages outside the time window.
+    # raw is the webhook request body, stored verbatim instead of re-encoding the dict.
+    snapshot_id = f"{next(_snapshot_ids):016x}{_SNAPSHOT_SUFFIX}"
 
     # Validate minimal structure (Green-API incomingMessageReceived)
     webhook_type = payload.get("typeWebhook")
     if not webhook_type:
+        _queue_payload_snapshot(payload, snapshot_id, raw)
         json_log("webhook_ignored", reason="missing_typeWebhook")
         return {"ok": True, "ignored": True}
     # Only process incoming messages; ignore outgoing echoes to avoid replying to ourselves
-    if str(webhook_type).lower() not in {"incomingmessagereceived"}:
+    if str(webhook_type).lower() not in _INCOMING_WEBHOOK_TYPES:
+        _queue_payload_snapshot(payload, snapshot_id, raw)
         json_log("webhook_ignored", reason="not_incoming", type=str(webhook_type))
         return {"ok": True, "ignored": True}
 
     # Extract sender, message id, media list heuristically
-    instance_id = payload.get("instanceData", {}).get("idInstance") or os.getenv("GREEN_API_INSTANCE_ID", "")
+    instance_id = payload.get("instanceData", {}).get("idInstance") or runtime_cfg.instance_id
     # Try multiple locations for sender/chat id; some notifications omit senderData
     message_data = payload.get("messageData") or {}
+    sender_data = payload.get("senderData") or {}
     sender = (
-        payload.get("senderData", {}).get("chatId")
-        or payload.get("senderData", {}).get("sender")
+        sender_data.get("chatId")
+        or sender_data.get("sender")
         or payload.get("chatId")
         or message_data.get("chatId")
         or payload.get("author")
         or "unknown"
     )
-    msg_id = payload.get("idMessage") or message_data.get("idMessage") or payload.get("receiptId") or ts
+    msg_id = payload.get("idMessage") or message_data.get("idMessage") or payload.get("receiptId") or snapshot_id
+
+    # Idempotency: Green API retries webhooks, so skip a message id we've already handled
+    # before doing any other work for it. Marked right away (one atomic statement) so a
+    # concurrent redelivery can't slip through.
+    if not db.mark_if_new(str(msg_id)):
+        existing = db.get_job_by_msg(str(instance_id), str(msg_id))
+        json_log("duplicate_message_skipped", msg_id=str(msg_id), sender=sender)
+        return {"ok": True, "duplicate": True, "msg_id": str(msg_id), "job_id": existing["id"] if existing else None}
 
     # Time window filter (3 minutes)
     now = datetime.now(tz=timezone.utc)
     evt_time = _extract_event_time(payload) or now
-    age = (now - evt_time).total_seconds()
-    if age > WINDOW_SECONDS:
-        json_log("message_skipped_outside_window", sender=sender, msg_id=str(msg_id), age_seconds=int(age))
-        return {"ok": True, "skipped": "outside_window", "age_seconds": int(age)}
-
-    # Idempotency: skip if we've already handled this message id
-    if db.has_processed(str(msg_id)):
-        json_log("duplicate_message_skipped", msg_id=str(msg_id), sender=sender)
-        return {"ok": True, "duplicate": True, "msg_id": str(msg_id)}
-
-    # Mark as processed early to avoid races on re-delivery
-    db.mark_processed(str(msg_id))
+    age = now - evt_time
+    if age > WINDOW_DELTA:
+        age_seconds = int(age.total_seconds())
+        json_log("message_skipped_outside_window", sender=sender, msg_id=str(msg_id), age_seconds=age_seconds)
+        return {"ok": True, "skipped": "outside_window", "age_seconds": age_seconds}
+    # Snapshot only messages that are actually handled; duplicates and stale ones returned above
+    _queue_payload_snapshot(payload, snapshot_id, raw)
 
-    media_list: List[Dict[str, Any]] = []
     try:
-        type_message = (message_data.get("typeMessage") or "").lower()
-        # Collect known single-media payloads
-        candidates = [
-            message_data.get("imageMessageData"),
-            message_data.get("videoMessageData"),
-            message_data.get("fileMessageData"),
-            message_data.get("documentMessageData"),
-            message_data.get("audioMessageData"),
-            message_data.get("voiceMessageData"),  # some providers use this for PTT/voice notes
-        ]
-        for c in candidates:
-            if isinstance(c, dict) and c:
-                media_list.append(c)
-        # Heuristic: if type mentions 'voice' and we have no explicit payload, treat audioMessageData as voice
-        if ("voice" in type_message or "ptt" in type_message) and not media_list:
-            amd = message_data.get("audioMessageData")
-            if isinstance(amd, dict) and amd:
-                media_list.append(amd)
-        # Multiple medias array
-        if "medias" in message_data and isinstance(message_data["medias"], list):
-            media_list.extend([m for m in message_data["medias"] if isinstance(m, dict)])
+        text, media_list, type_message = _classify(message_data)
     except Exception:
-        pass
+        text, media_list, type_message = None, [], ""
 
     # Feature: OCR/QA, YouTube, and search handling
-    from .ocr_qa import GeminiFileQA, state as qa_state, find_youtube_url
+    from .ocr_qa import get_file_qa, state as qa_state, find_youtube_url
 
-    client = GreenAPIClient.from_env()
+    client = get_green_client()
 
-    text_msg = _extract_text_from_payload(payload) or ""
+    text_msg = text or ""
+    # Stripped and lowercased once for every command check below
+    text_low = text_msg.strip().lower()
 
     # Simple greeting and math handlers (single concise replies)
     # IMPORTANT: If the chat has an active document Q&A session, skip math/greeting heuristics
@@ -1027,11 +1618,8 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
 
         if not has_active_sessions:
             try:
-                low_txt = text_msg.strip().lower()
-
                 # Greeting intent
-                greeting_words = {"hi", "hello", "hey", "good morning", "good afternoon", "good evening"}
-                if any(low_txt.startswith(w) or w in low_txt for w in greeting_words):
+                if any(w in text_low for w in _GREETING_WORDS):
                     if _is_sender_allowed(sender, db) and sender != "unknown":
                         await client.send_message(chat_id=sender, message="Hello! How can I help you today?")
                     return {"ok": True, "job_id": None}
@@ -1045,7 +1633,7 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                 # If it looks like a math question but local engine couldn't compute, fall back to Gemini immediately.
                 if _looks_like_math_intent(text_msg) and GeminiResponder is not None:
                     try:
-                        responder = GeminiResponder()
+                        responder = get_responder()
                         # Calculator-style prompt: force numeric result only
                         calc_prompt = "You are a calculator. Compute the expression and return ONLY the final numeric result."
                         reply = await asyncio.to_thread(responder.generate, text_msg, calc_prompt, sender)
@@ -1057,7 +1645,7 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                         pass
 
                 # If user just says "addition" without numbers, guide them once
-                if low_txt.strip() in {"addition", "add"}:
+                if text_low in _ADDITION_WORDS:
                     if _is_sender_allowed(sender, db) and sender != "unknown":
                         await client.send_message(chat_id=sender, message="Send a calculation like 2+2 or 7*(3+4).")
                     return {"ok": True, "job_id": None}
@@ -1067,33 +1655,24 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
 
     # One-time PDF packer command: "PDF:N" where N = images per page
     if text_msg:
-        m = re.match(r"^\s*pdf\s*:\s*(\d+)\s*$", text_msg, flags=re.IGNORECASE)
+        m = _PDF_CMD_RE.match(text_msg)
         if m:
             try:
                 per_page = max(1, min(12, int(m.group(1))))
             except Exception:
                 per_page = 4
             # Prepare a dedicated one-time PDF batch; timer will start after first image is received
-            async with pending_lock:
-                # Cancel existing batch for this sender if any
-                prev = pending_batches.get(sender)
-                if prev:
-                    try:
-                        t = prev.get("task")
-                        if t:
-                            t.cancel()
-                    except Exception:
-                        pass
-                    pending_batches.pop(sender, None)
+            async with _batch_lock(sender):
+                # Cancel existing batch for this sender if any (its timer entry is dropped when it fires)
+                pending_batches.pop(sender, None)
                 # Create a new job and store per-page setting in job logs
-                job_id = db.create_job(sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id))
-                db.append_job_log(job_id, {"pdf_images_per_page": per_page})
-                db.update_job_status(job_id, "NEW")
+                with db.transaction() as tx:
+                    job_id = tx.create_job(sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id), status="NEW")
+                    tx.append_job_log(job_id, {"pdf_images_per_page": per_page})
                 # Don't start the timer yet; wait for first image
                 pending_batches[sender] = {
                     "job_id": job_id,
                     "started_at": now.isoformat(),
-                    "task": None,
                     "mode": "pdf_once",
                     "per_page": per_page,
                     "window": 60,
@@ -1111,7 +1690,7 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
             md0 = payload.get("messageData") or {}
             has_image_in_msg = bool(md0.get("imageMessageData")) or (isinstance(md0.get("medias"), list) and any(isinstance(x, dict) and str((x.get("mimeType") or x.get("mimetype") or "")).lower().startswith("image/") for x in md0.get("medias") or []))
             if not has_image_in_msg:
-                async with pending_lock:
+                async with _batch_lock(sender):
                     b = pending_batches.get(sender)
                     if b and b.get("mode") == "pdf_once":
                         if _is_sender_allowed(sender, db):
@@ -1123,9 +1702,9 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
     # If awaiting yt-dlp resolution choice or confirmation
     pending_url = qa_state.get_pending_ytdl(sender)
     if pending_url:
-        choice_text = (text_msg or "").strip().lower()
+        choice_text = text_low
         # Cancellation
-        if choice_text in {"cancel", "stop", "no"}:
+        if choice_text in _YTDL_CANCEL_WORDS:
             qa_state.set_pending_ytdl(sender, None)
             ytdl_pending.pop(sender, None)
             if _is_sender_allowed(sender, db):
@@ -1154,7 +1733,7 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                         break
 
         # Fallback: accept yes/ok -> first choice or best<=480
-        if not selected_fmt and choice_text in {"yes", "y", "download", "ok"}:
+        if not selected_fmt and choice_text in _YTDL_CONFIRM_WORDS:
             if entry and entry.get("choices"):
                 selected_fmt = entry["choices"][0]
             else:
@@ -1173,31 +1752,50 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
         json_log("ytdl_choice_selected", sender=sender, choice=selected_fmt.get("label"), fmt=selected_fmt.get("format_id"))
 
         # download video, upload, send, delete
+        # Each download gets its own tmp subdir, so concurrent downloads can't pick up each other's file
+        tmp_dir = storage.base / "tmp" / f"yt_{uuid.uuid4().hex}"
         try:
-            tmp_dir = storage.base / "tmp"
             tmp_dir.mkdir(parents=True, exist_ok=True)
             out_tpl = str(tmp_dir / "yt_video.%(ext)s")
             fmt_selector = str(selected_fmt.get("format_id") or "best")
             url_norm = _normalize_youtube_url(pending_url)
-            # Build exec args to avoid shell quoting issues on Windows
-            args = [
-                "yt-dlp",
-                "--no-playlist",
-                "--force-ipv4",
-                "--extractor-args", "youtube:player_client=android",
-                "--no-part",
-                "--retries", "3",
-                "--fragment-retries", "3",
-                "-f", fmt_selector,
-                "-o", out_tpl,
-                url_norm,
-            ]
-            json_log("ytdl_download_started", sender=sender, cmd=" ".join(args))
-            proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            stdout, stderr = await proc.communicate()
-            err_txt = stderr.decode('utf-8', 'ignore')
-            if proc.returncode != 0:
-                json_log("ytdl_download_failed", sender=sender, code=proc.returncode, stderr=err_txt[:300])
+            exts = (".mp4", ".mkv", ".webm", ".mov", ".m4v")
+            candidates: List[Path] = []
+            if yt_dlp is not None:
+                # In-process: no interpreter start-up per download, and yt-dlp reports the file it wrote
+                json_log("ytdl_download_started", sender=sender, url=url_norm, fmt=fmt_selector)
+                opts = {"nopart": True, "retries": 3, "fragment_retries": 3, "format": fmt_selector, "outtmpl": out_tpl}
+                try:
+                    info = await asyncio.wait_for(asyncio.to_thread(_ytdl_extract, url_norm, opts, True), timeout=1800)
+                    returncode, err_txt = 0, ""
+                    for d in info.get("requested_downloads") or []:
+                        fp = d.get("filepath")
+                        if fp and Path(fp).suffix.lower() in exts and Path(fp).exists():
+                            candidates.append(Path(fp))
+                except Exception as e:
+                    returncode, err_txt = 1, str(e)
+            else:
+                # Build exec args to avoid shell quoting issues on Windows
+                args = [
+                    "yt-dlp",
+                    "--no-playlist",
+                    "--force-ipv4",
+                    "--extractor-args", "youtube:player_client=android",
+                    "--no-part",
+                    "--retries", "3",
+                    "--fragment-retries", "3",
+                    "-f", fmt_selector,
+                    "-o", out_tpl,
+                    url_norm,
+                ]
+                json_log("ytdl_download_started", sender=sender, cmd=" ".join(args))
+                returncode, stdout, stderr = await _run_subprocess(*args, timeout=1800)
+                err_txt = stderr.decode('utf-8', 'ignore')
+                if returncode == 0:
+                    # The subdir holds only this download's output (--no-part: no leftovers)
+                    candidates = [p for p in tmp_dir.iterdir() if p.suffix.lower() in exts]
+            if returncode != 0:
+                json_log("ytdl_download_failed", sender=sender, code=returncode, stderr=err_txt[:300])
                 if _is_sender_allowed(sender, db):
                     # Common hint if ffmpeg missing or geo/consent restricted
                     hint = ""
@@ -1207,10 +1805,6 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                         hint = " (video requires login/consent; cannot fetch without cookies)"
                     await client.send_message(chat_id=sender, message=f"Failed to download video{hint}.")
             else:
-                # find the produced file (prefer non-part, newest)
-                exts = (".mp4", ".mkv", ".webm", ".mov", ".m4v")
-                candidates = [p for p in tmp_dir.glob("yt_video.*") if p.suffix.lower() in exts and not str(p).endswith(".part")]
-                candidates.sort(key=lambda p: p.stat().st_mtime, reverse=True)
                 if not candidates:
                     json_log("ytdl_download_no_output", sender=sender)
                     if _is_sender_allowed(sender, db):
@@ -1235,6 +1829,7 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                 await client.send_message(chat_id=sender, message=f"Error while downloading video: {e}")
             qa_state.set_pending_ytdl(sender, None)
             ytdl_pending.pop(sender, None)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
         return {"ok": True, "job_id": None}
 
     # If text contains a YouTube link
@@ -1265,13 +1860,14 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
         return {"ok": True, "job_id": None}
 
     # Simple internet search command: "search: ..."
-    if text_msg.lower().startswith("search:") or text_msg.lower().startswith("search "):
-        raw_query = text_msg.split(":", 1)[1].strip() if ":" in text_msg else text_msg.split(" ", 1)[1].strip()
+    if text_low.startswith(("search:", "search ")):
+        cmd = text_msg.strip()
+        raw_query = cmd.split(":", 1)[1].strip() if ":" in cmd else cmd.split(" ", 1)[1].strip()
         # Let Gemma/Gemini sharpen the query
         query = raw_query
         try:
             if GeminiResponder is not None:
-                gr = GeminiResponder()
+                gr = get_responder()
                 query = await asyncio.to_thread(gr.rewrite_search_query, raw_query)
         except Exception:
             query = raw_query
@@ -1284,7 +1880,7 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                 intro = f"Top results for \"{query}\":"
                 try:
                     if GeminiResponder is not None:
-                        gr = GeminiResponder()
+                        gr = get_responder()
                         intro = await asyncio.to_thread(
                             gr.generate,
                             f"Write a short, friendly one-line intro for search results about: {query}",
@@ -1298,7 +1894,7 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
         return {"ok": True, "job_id": None}
 
     # Image fetch command: "image: cats jpg" or "img: cat" or any text mentioning image/photo/picture/img
-    low = (text_msg or "").strip().lower()
+    low = text_low
     def _looks_like_image_intent(s: str) -> bool:
         if s.startswith("image:") or s.startswith("img:"):
             return True
@@ -1325,68 +1921,67 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
 
     # Toggle: if pdf_packer_enabled -> existing batching to PDF, else switch to QA mode
     # Default disabled; can be enabled per-chat via a one-time "PDF:N" command
-    pdf_packer_enabled = (db.get_setting("pdf_packer_enabled", "0") or "0") == "1"
+    pdf_packer_enabled = (db.get_setting_cached("pdf_packer_enabled", "0") or "0") == "1"
 
     # Split media into images vs others (audio/voice/pdf/etc.)
-    def _is_image_media(m: Dict[str, Any]) -> bool:
-        mt = (m.get("mimeType") or m.get("mimetype") or "").lower()
-        if mt.startswith("image/"):
-            return True
-        name = (m.get("fileName") or m.get("caption") or "").lower()
-        return any(name.endswith(ext) for ext in (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff", ".bmp"))
-
-    image_media = [m for m in media_list if _is_image_media(m)]
-    other_media = [m for m in media_list if not _is_image_media(m)]
+    image_media: List[Dict[str, Any]] = []
+    other_media: List[Dict[str, Any]] = []
+    for m in media_list:
+        (image_media if _is_image_media(m) else other_media).append(m)
 
     # If we have image media and a one-time PDF batch is active, always append to that batch
     if image_media:
-        async with pending_lock:
+        async with _batch_lock(sender):
             b = pending_batches.get(sender)
             if b and b.get("mode") == "pdf_once":
                 job_id = b["job_id"]
-                for m in image_media:
-                    db.add_media(job_id, m)
+                db.add_medias(job_id, image_media)
                 # Start countdown timer on first image if not already started
-                if not b.get("task"):
+                if not b.get("deadline"):
                     try:
-                        t = asyncio.create_task(_enqueue_pdf_once_later(sender, db, window=int(b.get("window", 60))))
-                        b["task"] = t
-                        pending_batches[sender] = b
+                        _schedule_batch_flush(sender, b, int(b.get("window", 60)))
                     except Exception:
                         pass
                     # Notify timer started
                     if _is_sender_allowed(sender, db):
                         try:
-                            await client.send_message(chat_id=sender, message="Timer started. I'll create the PDF in 1 minute.")
+                            await client.send_message_batched(chat_id=sender, message="Timer started. I'll create the PDF in 1 minute.", wait=False)
                         except Exception:
                             pass
                 json_log("pdf_once_batch_appended", sender=sender, job_id=job_id, added=len(image_media))
                 if not other_media:
                     if _is_sender_allowed(sender, db):
                         try:
-                            await client.send_message(chat_id=sender, message=f"Added {len(image_media)} image(s).")
+                            await client.send_message_batched(chat_id=sender, message=f"Added {len(image_media)} image(s).", wait=False)
                         except Exception:
                             pass
                     return {"ok": True, "job_id": job_id}
 
     # If we have image media and packer is enabled, batch only images for PDF
     if image_media and pdf_packer_enabled:
-        async with pending_lock:
+        async with _batch_lock(sender):
             batch = pending_batches.get(sender)
             if batch:
                 job_id = batch["job_id"]
-                for m in image_media:
-                    db.add_media(job_id, m)
+                db.add_medias(job_id, image_media)
                 json_log("batch_appended", sender=sender, job_id=job_id, added=len(image_media))
                 result_job_id = job_id
             else:
-                job_id = db.create_job(sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id))
-                for m in image_media:
-                    db.add_media(job_id, m)
-                db.update_job_status(job_id, "NEW")
-                task = asyncio.create_task(_enqueue_batch_later(sender, db))
-                pending_batches[sender] = {"job_id": job_id, "started_at": now.isoformat(), "task": task}
-                json_log("batch_started", sender=sender, job_id=job_id, window_seconds=BATCH_WINDOW_SECONDS, medias=len(image_media))
+                # Job, its incoming-payload log entry and media rows commit together
+                at_cap = len(pending_batches) >= MAX_PENDING_BATCHES
+                with db.transaction() as tx:
+                    job_id = tx.create_job(
+                        sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id),
+                        status="PENDING" if at_cap else "NEW",
+                    )
+                    tx.add_medias(job_id, image_media)
+                if at_cap:
+                    await job_queue.put(job_id)
+                    json_log("batch_skipped", reason="max_pending_batches", sender=sender, job_id=job_id, medias=len(image_media))
+                else:
+                    pending_batches[sender] = {"job_id": job_id, "started_at": now.isoformat()}
+                    _schedule_batch_flush(sender, pending_batches[sender], BATCH_WINDOW_SECONDS)
+                    json_log("batch_started", sender=sender, job_id=job_id, window_seconds=BATCH_WINDOW_SECONDS, medias=len(image_media))
                 result_job_id = job_id
         # Continue processing any non-image media immediately below
         if not other_media:
@@ -1404,18 +1999,31 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
             pass
 
         # Immediate download and create a separate session for this message (no batching)
-        async with httpx.AsyncClient(timeout=60) as http_client:
-            job_id = db.create_job(sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id))
-            db.update_job_status(job_id, "PROCESSING")
-            downloaded: List[Path] = []
-            for m in process_list:
-                try:
-                    fp = await storage.download_media(http_client, m, {"sender": sender, "msg_id": str(msg_id)})
-                    db.add_media(job_id, m)
-                    downloaded.append(fp)
-                except Exception as e:
-                    json_log("media_download_error", error=str(e))
-            db.update_job_status(job_id, "COMPLETED")
+        # Downloads share the process-wide connection pool
+        http_client = get_shared_client()
+        job_id = db.create_job(sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id), status="PROCESSING")
+        dl_job = {"sender": sender, "msg_id": str(msg_id)}
+        dl_sem = asyncio.Semaphore(MAX_DL_PER_JOB)
+
+        async def _download(m: Dict[str, Any]) -> Path:
+            async with dl_sem, _media_dl_sem:
+                return await storage.download_media(http_client, m, dl_job)
+
+        # Downloads run concurrently; a failed item is logged and skipped, order is preserved
+        results = await asyncio.gather(*(_download(m) for m in process_list), return_exceptions=True)
+        downloaded: List[Path] = []
+        downloaded_media: List[Dict[str, Any]] = []
+        for m, res in zip(process_list, results):
+            if isinstance(res, BaseException):
+                if isinstance(res, asyncio.CancelledError):
+                    raise res
+                json_log("media_download_error", error=str(res))
+                continue
+            downloaded_media.append(m)
+            downloaded.append(res)
+        with db.transaction() as tx:
+            tx.add_medias(job_id, downloaded_media)
+            tx.update_job_status(job_id, "COMPLETED")
 
         # Optional conversion: convert audio to mp3 for better support
         async def _convert_audio_to_mp3(path: Path) -> Path:
@@ -1424,12 +2032,11 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                     return path
                 # Use ffmpeg to convert to mono 64kbps mp3
                 out = path.with_suffix(".mp3")
-                proc = await asyncio.create_subprocess_exec(
+                returncode, _, _ = await _run_subprocess(
                     "ffmpeg", "-y", "-i", str(path), "-vn", "-ac", "1", "-b:a", "64k", str(out),
-                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+                    timeout=300,
                 )
-                await proc.communicate()
-                if proc.returncode == 0 and out.exists():
+                if returncode == 0 and out.exists():
                     return out
             except Exception:
                 pass
@@ -1477,15 +2084,16 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
 
     # If text and we are in QA mode for this chat
     if text_msg:
-        low = text_msg.strip().lower()
         from .ocr_qa import state as _state
         # Commands for sessions
-        if low in {"stop", "exit", "quit"}:
+        qa_cmd = _QA_COMMAND_RE.fullmatch(text_msg.strip())
+        cmd = (qa_cmd.group(1) or qa_cmd.group(2)).lower() if qa_cmd else None
+        if cmd in _QA_STOP_WORDS:
             _state.clear_all(sender, storage)
             if _is_sender_allowed(sender, db):
                 await client.send_message(chat_id=sender, message="Okay, exiting document Q&A mode. I deleted your files.")
             return {"ok": True, "job_id": None}
-        if low == "list":
+        if cmd == "list":
             sessions = _state.list_sessions(sender)
             if _is_sender_allowed(sender, db):
                 if not sessions:
@@ -1494,14 +2102,14 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
                     lines = [f"{s.id} · {len(s.files)} file(s)" for s in sessions]
                     await client.send_message(chat_id=sender, message="Sessions:\n" + "\n".join(lines))
             return {"ok": True, "job_id": None}
-        if low.startswith("use "):
-            sid = text_msg.strip().split(" ", 1)[1].strip()
+        if cmd == "use":
+            sid = qa_cmd.group(3).strip()
             ok = _state.set_active(sender, sid)
             if _is_sender_allowed(sender, db):
                 await client.send_message(chat_id=sender, message=("Switched to session " + sid) if ok else "I can't find that session id.")
             return {"ok": True, "job_id": None}
-        if low.startswith("delete "):
-            sid = text_msg.strip().split(" ", 1)[1].strip()
+        if cmd == "delete":
+            sid = qa_cmd.group(3).strip()
             _state.delete_session(sender, sid, storage)
             if _is_sender_allowed(sender, db):
                 await client.send_message(chat_id=sender, message=f"Deleted session {sid}.")
@@ -1510,10 +2118,12 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
         sessions = _state.list_sessions(sender)
         if sessions:
             try:
-                system_prompt = db.get_setting("auto_reply_system_prompt", "") or os.getenv(
-                    "GEMINI_SYSTEM_PROMPT", "Answer strictly from the provided file(s)."
+                system_prompt = (
+                    db.get_setting_cached("auto_reply_system_prompt", "")
+                    or runtime_cfg.gemini_system_prompt
+                    or "Answer strictly from the provided file(s)."
                 )
-                qa = GeminiFileQA()
+                qa = get_file_qa()
                 ans, correction = qa.answer_with_correction(sender, text_msg, system_prompt)
                 if _is_sender_allowed(sender, db):
                     # First send the exact/file-based answer
@@ -1527,21 +2137,27 @@ async def handle_incoming_payload(payload: Dict[str, Any], db: Database) -> Dict
             return {"ok": True, "job_id": None}
 
     # If no media and not QA/text special, create a job just to track non-media message; complete immediately
-    job_id = db.create_job(sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id))
-    db.update_job_status(job_id, "COMPLETED")
+    job_id = db.create_job(sender=sender, msg_id=str(msg_id), payload=payload, instance_id=str(instance_id), status="COMPLETED")
     json_log("no_media_payload_stored", job_id=job_id)
 
     # Use Gemini for general questions when no document session handled it, unless suppressed after PDF generation
     if text_msg and GeminiResponder is not None and _is_sender_allowed(sender, db) and not _is_suppressed_from_gemini(sender):
         try:
-            system_prompt = db.get_setting("auto_reply_system_prompt", "") or os.getenv(
-                "GEMINI_SYSTEM_PROMPT", "You are a helpful assistant. Identify the user's intent and respond concisely."
+            system_prompt = (
+                db.get_setting_cached("auto_reply_system_prompt", "")
+                or runtime_cfg.gemini_system_prompt
+                or "You are a helpful assistant. Identify the user's intent and respond concisely."
             )
-            responder = GeminiResponder()
-            # Offload blocking SDK call to a thread to keep loop responsive
-            reply = await asyncio.to_thread(responder.generate, text_msg, system_prompt, sender)
+            # Show "typing…" right away; the reply itself does not wait for this
+            typing = _spawn(client.send_chat_state(sender))
+            responder = get_responder()
+            # Offload blocking SDK call to a thread to keep loop responsive; bounded like auto-replies
+            timing: Dict[str, Optional[float]] = {}
+            async with _reply_sem:
+                reply = await asyncio.to_thread(responder.generate, text_msg, system_prompt, sender, timing)
             await client.send_message(chat_id=sender, message=reply)
-            json_log("fallback_gemini_reply_sent", chat_id=sender)
+            typing.cancel()
+            json_log("fallback_gemini_reply_sent", chat_id=sender, latency_s=timing.get("latency"))
         except Exception as e:
             json_log("fallback_gemini_reply_error", error=str(e))
 
@@ -1554,27 +2170,18 @@ async def notification_poller():
     through the same handler as the /webhook.
     """
     db = Database()
-    client = GreenAPIClient.from_env()
-    while True:
-        try:
-            data = await client.receive_notification()
-            if not data:
-                await asyncio.sleep(0.5)
-                continue
-            receipt_id = data.get("receiptId")
-            body = data.get("body") or data
-            res = await handle_incoming_payload(body, db)
-            json_log("receive_notification_handled", **{"ok": res.get("ok", False), "job_id": res.get("job_id")})
-            if receipt_id is not None:
-                try:
-                    await client.delete_notification(int(receipt_id))
-                except Exception as e:
-                    json_log("delete_notification_error", error=str(e), receipt_id=receipt_id)
-        except asyncio.CancelledError:
-            raise
-        except Exception as e:
-            json_log("receive_notification_error", error=str(e))
-            await asyncio.sleep(2.0)
+    client = get_green_client()
+
+    async def _handle(data: Dict[str, Any]) -> None:
+        body = data.get("body") or data
+        res = await handle_incoming_payload(body, db)
+        json_log("receive_notification_handled", **{"ok": res.get("ok", False), "job_id": res.get("job_id")})
+
+    def _on_error(stage: str, exc: BaseException, receipt_id: Any) -> None:
+        json_log(f"{stage}_error", error=str(exc), receipt_id=receipt_id)
+
+    # More than one poller can receive the same notification before it is deleted
+    await client.run_poller(_handle, workers=int(os.getenv("POLLER_WORKERS", "1")), on_error=_on_error)
 
 
 async def qa_cleanup_loop():
@@ -1592,17 +2199,58 @@ async def qa_cleanup_loop():
         await asyncio.sleep(1800)  # every 30 minutes
 
 
+async def wal_checkpoint_loop():
+    """
+    Checkpoint the SQLite WAL from a worker thread when the job log has grown,
+    so the automatic checkpoint does not stall a write burst.
+    """
+    db = Database()
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await asyncio.to_thread(db.checkpoint_if_needed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            json_log("wal_checkpoint_error", error=str(e))
+
+
+# Pre-serialized webhook responses (same bytes JSONResponse would produce)
+_OK_JOB_PREFIX = b'{"ok":true,"job_id":'
+_IGNORED_RESULT = {"ok": True, "ignored": True}
+_IGNORED_BODY = b'{"ok":true,"ignored":true}'
+_QUEUE_FULL_BODY = b'{"ok":false,"error":"queue_full"}'
+
+
+def _json_bytes_response(body: bytes, status_code: int = 200) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
+
 @app.post("/webhook")
 async def webhook(request: Request, db: Database = Depends(get_db)):
+    raw = await request.body()
     try:
-        payload = await request.json()
-    except Exception:
-        raw = await request.body()
-        return JSONResponse({"ok": False, "error": "invalid_json", "raw": raw.decode("utf-8", "ignore")}, status_code=400)
+        payload = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return _json_bytes_response(
+            orjson.dumps({"ok": False, "error": "invalid_json", "raw": raw.decode("utf-8", "ignore")}), 400
+        )
+
+    if job_queue.full():
+        # Backpressure: Green API redelivers the webhook later
+        json_log("webhook_rejected", reason="queue_full", size=job_queue.qsize())
+        return _json_bytes_response(_QUEUE_FULL_BODY, 503)
 
-    res = await handle_incoming_payload(payload, db)
+    res = await handle_incoming_payload(payload, db, raw)
     status = 200 if res.get("ok") else 400
-    return JSONResponse(res, status_code=status)
+    # The two common shapes are built from constant bytes; anything else goes through orjson
+    if res == _IGNORED_RESULT:
+        body = _IGNORED_BODY
+    elif len(res) == 2 and res.get("ok") is True and "job_id" in res and (res["job_id"] is None or isinstance(res["job_id"], int)):
+        body = _OK_JOB_PREFIX + (b"null" if res["job_id"] is None else str(res["job_id"]).encode()) + b"}"
+    else:
+        body = orjson.dumps(res, default=str)
+    return _json_bytes_response(body, status)
 
 
 @app.get("/")
@@ -1619,31 +2267,20 @@ async def _web_search_links(query: str) -> List[str]:
     q = query.strip().replace(" ", "+")
     url = f"https://duckduckgo.com/html/?q={q}"
     try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            r = await client.get(url, headers={"User-Agent": "Mozilla/5.0"})
-            if r.status_code != 200:
-                return []
-            html = r.text
-            import re
-            links = re.findall(r'<a rel="nofollow" class="result__a" href="([^"]+)"', html)
-            # Clean /l/?kh=-1&uddg= encoded
-            cleaned: List[str] = []
-            from urllib.parse import urlparse, parse_qs, unquote
-            for L in links:
-                if "/l/?" in L and "uddg=" in L:
-                    qs = parse_qs(urlparse(L).query)
-                    tgt = qs.get("uddg", [""])[0]
-                    cleaned.append(unquote(tgt))
-                else:
-                    cleaned.append(L)
-            # de-dup
-            out = []
-            seen = set()
-            for u in cleaned:
-                if u not in seen:
-                    seen.add(u)
-                    out.append(u)
-            return out[:10]
+        r = await get_shared_client().get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=20)
+        if r.status_code != 200:
+            return []
+        html = r.text
+        links = _DDG_LINK_RE.findall(html)
+        # Clean /l/?kh=-1&uddg= encoded: the target is the one uddg value, cut out without parse_qs
+        cleaned: List[str] = []
+        for L in links:
+            if "/l/?" in L and "uddg=" in L:
+                cleaned.append(unquote(L.partition("uddg=")[2].partition("&")[0]))
+            else:
+                cleaned.append(L)
+        # de-dup, keeping order
+        return list(dict.fromkeys(cleaned))[:10]
     except Exception:
         return []
 
@@ -1653,12 +2290,75 @@ async def health():
     return {"ok": True, "version": VERSION}
 
 
+def _server_impls() -> Dict[str, str]:
+    """
+    Pick uvloop/httptools when importable (uvicorn[standard] installs both on Linux/macOS),
+    else the pure-Python asyncio loop and h11 parser (e.g. on Windows, where uvloop isn't available).
+    """
+    impls = {"loop": "asyncio", "http": "h11"}
+    try:
+        import uvloop  # noqa: F401
+        impls["loop"] = "uvloop"
+    except ImportError:
+        pass
+    try:
+        import httptools  # noqa: F401
+        impls["http"] = "httptools"
+    except ImportError:
+        pass
+    return impls
+
+
+# Flows whose state is held in memory per server process. With WEB_CONCURRENCY > 1 the
+# follow-up message of any of these may reach a different process and be silently dropped.
+_PER_PROCESS_STATE = (
+    "PDF batching: open batches, their timers and PDF:N requests",
+    "document Q&A: sessions, the active session and 'use'/'delete'/'list'/'stop'",
+    "yt-dlp: the pending quality choice ('1', '2', 'yes', 'cancel')",
+    "Gemini chat memory and summaries",
+    "Gemini suppression after a PDF is sent",
+)
+
+
 def run():
     import uvicorn
 
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8080"))
-    uvicorn.run("app.main:app", host=host, port=port, reload=False)
+    # Server processes; each runs its own event loop and job workers. PDF composition and
+    # webhook handling then spread over cores instead of sharing one loop. Only safe for
+    # stateless traffic: every flow in _PER_PROCESS_STATE keeps per-process memory, so keep 1
+    # while relying on them (on_startup logs a warning otherwise).
+    web_concurrency = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    impls = _server_impls()
+    json_log("server_impls", web_concurrency=web_concurrency, **impls)
+    if web_concurrency > 1:
+        try:
+            import gunicorn  # noqa: F401  (not available on Windows)
+        except ImportError:
+            gunicorn = None
+        if gunicorn is not None:
+            import subprocess
+
+            # UvicornWorker picks uvloop/httptools itself when they are installed
+            cmd = [
+                sys.executable, "-m", "gunicorn", "app.main:app",
+                "-k", "uvicorn.workers.UvicornWorker",
+                "-w", str(web_concurrency),
+                "-b", f"{host}:{port}",
+            ]
+            if Path("/dev/shm").is_dir():
+                cmd += ["--worker-tmp-dir", "/dev/shm"]
+            raise SystemExit(subprocess.call(cmd))
+    uvicorn.run(
+        "app.main:app",
+        host=host,
+        port=port,
+        reload=False,
+        workers=web_concurrency,
+        loop=impls["loop"],
+        http=impls["http"],
+    )
 
 
 if __name__ == "__main__":
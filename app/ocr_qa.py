@@ -8,6 +8,7 @@ from typing import Dict, List, Optional, Tuple
 import google.generativeai as genai
 
 from .db import Database
+from .gemini import build_model, use_api_key
 from .storage import Storage
 
 
@@ -134,8 +135,8 @@ class GeminiFileQA:
         )
         # Default to a multimodal model suitable for PDFs/images and multilingual (Sinhala) answers
         model = configured or "gemini-2.5-flash-lite"
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model)
+        self._api_key = api_key
+        self.model = build_model(api_key, model)
 
     def _upload_for_session(self, chat_id: str, session_id: str, files: List[Path]) -> List[object]:
         uploaded_by_chat = state.gemini_files.setdefault(chat_id, {})
@@ -143,6 +144,7 @@ class GeminiFileQA:
         if cached is not None and len(cached) > 0:
             return cached
         handles = []
+        use_api_key(self._api_key)
         for p in files:
             try:
                 handle = genai.upload_file(path=str(p))
@@ -245,6 +247,23 @@ class GeminiFileQA:
             return file_only_answer, None
 
 
+# Shared GeminiFileQA with the (api_key, model) it was built from; rebuilt when either setting
+# changes instead of configuring a new model for every question.
+_file_qa: Optional[Tuple[Tuple[Optional[str], Optional[str]], GeminiFileQA]] = None
+
+
+def get_file_qa() -> GeminiFileQA:
+    global _file_qa
+    db = Database()
+    settings = (
+        db.get_setting_cached("GEMINI_API_KEY", None) or os.getenv("GEMINI_API_KEY"),
+        db.get_setting_cached("GEMINI_MODEL", None) or os.getenv("GEMINI_MODEL"),
+    )
+    if _file_qa is None or _file_qa[0] != settings:
+        _file_qa = (settings, GeminiFileQA())
+    return _file_qa[1]
+
+
 # Broader YouTube URL matcher: supports watch, youtu.be, shorts, and mobile links with extra params
 YOUTUBE_RE = re.compile(
     r"(https?://(?:www\\.)?(?:m\\.)?(?:youtube\\.com/(?:watch\\?[^ \\n]+|shorts/[^ \\n]+)|youtu\\.be/[^ \\n]+))",
@@ -1059,3 +1059,15 @@ class PDFComposer:
         allow_upscale = True
         stretch = True
         return success_cells, len(success_cells), allow_upscale, stretch
+
+
+# Process-pool entry point -------------------------------------------------
+# Worker processes build their own composer once; only paths and the job dict cross the process boundary.
+_process_composers: Dict[str, PDFComposer] = {}
+
+
+def compose_in_process(storage_base: str, job: Dict, image_files: List[str]) -> PDFComposeResult:
+    composer = _process_composers.get(storage_base)
+    if composer is None:
+        composer = _process_composers[storage_base] = PDFComposer(storage=Storage(base=Path(storage_base)))
+    return composer.compose(job, [Path(p) for p in image_files])
@@ -1,10 +1,22 @@
-import json
+import os
 import shutil
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Optional
 
 import httpx
+import orjson
+
+
+def _write_bytes_atomic(path: Path, data: bytes) -> None:
+    """
+    Write via a sibling temp file and os.replace so readers never observe a
+    truncated file and a crash mid-write leaves the previous version intact.
+    """
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with tmp.open("wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
 
 
 class Storage:
@@ -23,10 +35,14 @@ class Storage:
         ]:
             p.mkdir(parents=True, exist_ok=True)
 
-    def save_incoming_payload(self, payload: Dict[str, Any], name: str) -> Path:
-        p = self.base / "incoming_payloads" / name
-        # Write as UTF-8 to support emojis and non-ASCII safely across platforms (Windows codepages).
-        p.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    def append_incoming_payloads(self, lines: List[bytes]) -> Path:
+        """
+        Append ready-made JSONL lines ({"id": ..., "payload": ...}) to today's payload log in one
+        write. Files are per day and per process, so concurrent server processes never interleave.
+        """
+        p = self.base / "incoming_payloads" / f"{datetime.utcnow().strftime('%Y%m%d')}_{os.getpid()}.jsonl"
+        with p.open("ab") as f:
+            f.write(b"".join(lines))
         return p
 
     def raw_dir_for(self, sender: str, msg_id: str) -> Path:
@@ -51,38 +67,52 @@ class Storage:
             raise ValueError("No media URL in payload")
 
         raw_dir = self.raw_dir_for(job["sender"], job["msg_id"])
-        # ensure deterministic index ordering by creating a numbered filename if collision
+        # ensure deterministic index ordering by creating a numbered filename if collision.
+        # The name is reserved with an empty placeholder so concurrent downloads of the same
+        # job can't pick the same target while the first one is still in flight.
         target = raw_dir / filename
         base = target.stem
         ext = target.suffix or ".bin"
         i = 1
-        while target.exists():
-            target = raw_dir / f"{base}_{i:03d}{ext}"
-            i += 1
+        while True:
+            try:
+                os.close(os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                target = raw_dir / f"{base}_{i:03d}{ext}"
+                i += 1
 
         # stream download to tmp then move
-        tmp = self.base / "tmp" / f"dl_{target.name}"
+        tmp = self.base / "tmp" / f"dl_{job.get('id', '')}_{target.name}"
         tmp.parent.mkdir(parents=True, exist_ok=True)
 
         # retry 3x with backoff
         last_exc: Optional[Exception] = None
-        for attempt in range(3):
-            try:
-                async with http_client.stream("GET", url) as resp:
-                    resp.raise_for_status()
-                    with tmp.open("wb") as f:
-                        async for chunk in resp.aiter_bytes():
-                            f.write(chunk)
-                break
-            except Exception as e:
-                last_exc = e
-        if last_exc:
-            raise last_exc
+        try:
+            for attempt in range(3):
+                try:
+                    async with http_client.stream("GET", url) as resp:
+                        resp.raise_for_status()
+                        with tmp.open("wb") as f:
+                            async for chunk in resp.aiter_bytes():
+                                f.write(chunk)
+                    last_exc = None
+                    break
+                except Exception as e:
+                    last_exc = e
+            if last_exc:
+                raise last_exc
+        except BaseException:
+            # Failed or cancelled (e.g. a sibling download of the job failed): release the
+            # reserved name and drop the partial file
+            target.unlink(missing_ok=True)
+            tmp.unlink(missing_ok=True)
+            raise
 
         shutil.move(str(tmp), str(target))
         # write meta next to file
         meta = {"source_url": url, "saved_at": datetime.utcnow().isoformat() + "Z"}
-        (raw_dir / "meta.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+        _write_bytes_atomic(raw_dir / "meta.json", orjson.dumps(meta, option=orjson.OPT_INDENT_2))
         return target
 
     def delete_files(self, paths: List[Path]):
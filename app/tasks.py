@@ -1,7 +1,22 @@
 import asyncio
+import os
 from typing import List
 
 # Shared background job queue and worker task list.
 # Kept in a separate module to avoid circular imports between main and webui.
-job_queue: "asyncio.Queue[int]" = asyncio.Queue()
-workers: List[asyncio.Task] = []
\ No newline at end of file
+# Bounded so a webhook burst pushes back (503) instead of growing memory without limit;
+# jobs live in the DB, so anything queued but unprocessed is re-enqueued on startup.
+# Nothing join()s these queues, so consumers skip task_done(); shutdown waits on the worker tasks.
+QUEUE_MAX = int(os.getenv("QUEUE_MAX", "1024"))
+job_queue: "asyncio.Queue[int]" = asyncio.Queue(maxsize=QUEUE_MAX)
+workers: List[asyncio.Task] = []
+
+
+async def get_batch(q: "asyncio.Queue[int]", max_n: int) -> List[int]:
+    """
+    Wait for one item, then take whatever else is already queued, up to max_n in total.
+    """
+    batch = [await q.get()]
+    while len(batch) < max_n and not q.empty():
+        batch.append(q.get_nowait())
+    return batch
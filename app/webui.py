@@ -1,11 +1,14 @@
+import asyncio
+import heapq
 import os
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse
 
 from .db import Database, get_db
+from .green_api import GreenAPIClient, invalidate_settings_cache
 from .tasks import job_queue
 from .storage import Storage
 
@@ -31,6 +34,27 @@ def _pretty_chat(chat: Optional[str]) -> str:
     return s
 
 
+def _recent_pdfs(limit: int = 20) -> List[Path]:
+    """
+    Newest PDFs in storage/pdf. A single scandir pass reuses the directory entries
+    (no separate glob + stat per file) and nlargest avoids sorting the whole folder.
+    """
+    entries = []
+    try:
+        with os.scandir(storage.base / "pdf") as it:
+            for e in it:
+                if not e.name.endswith(".pdf"):
+                    continue
+                try:
+                    if e.is_file(follow_symlinks=False):
+                        entries.append((e.stat().st_mtime, e.path))
+                except OSError:
+                    continue
+    except OSError:
+        return []
+    return [Path(p) for _, p in heapq.nlargest(limit, entries)]
+
+
 def check_auth(token: Optional[str], db: Optional[Database] = None):
     expected = None
     if db:
@@ -197,7 +221,7 @@ def ui(db: Database = Depends(get_db), token: Optional[str] = Query(default=None
             "SELECT id, sender, msg_id, status, created_at, pdf_path FROM jobs ORDER BY id DESC LIMIT 100"
         ).fetchall()
 
-    pdf_files = sorted((storage.base / "pdf").glob("*.pdf"), key=lambda p: p.stat().st_mtime, reverse=True)[:20]
+    pdf_files = _recent_pdfs(20)
 
     rows = ""
     for j in jobs:
@@ -516,7 +540,10 @@ async def resend(job_id: int, db: Database = Depends(get_db), token: Optional[st
     job = db.get_job(job_id)
     if not job:
         raise HTTPException(404, "job not found")
-    await job_queue.put(job_id)
+    try:
+        job_queue.put_nowait(job_id)
+    except asyncio.QueueFull:
+        raise HTTPException(503, "job queue is full, try again shortly")
     db.update_job_status(job_id, "PENDING")
     return JSONResponse({"ok": True, "job_id": job_id})
 
@@ -572,6 +599,23 @@ async def save_settings(request: Request, db: Database = Depends(get_db), token:
     ]:
         val = form.get(key)
         if val is not None:
+            if key == "GREEN_API_INSTANCE_ID" and (val or "").strip() != (db.get_setting(key, "") or ""):
+                # A different instance may have a different tariff: re-probe sendImageByUrl
+                db.set_setting("GREEN_IMAGE_FORBIDDEN", "0")
+                GreenAPIClient._image_endpoint_forbidden = None
             db.set_setting(key, (val or "").strip())
 
+    # Clients and responders cache these settings briefly; drop the caches so changes apply now
+    invalidate_settings_cache()
+    try:
+        from .gemini import invalidate_api_key_cache
+    except ImportError:
+        pass  # Gemini SDK not installed: nothing is cached
+    else:
+        try:
+            invalidate_api_key_cache()
+        except Exception as e:
+            from .main import json_log  # imported here: app.main imports this module
+            json_log("settings_cache_invalidate_error", cache="gemini_api_key", error=str(e))
+
     return RedirectResponse(url=f"/ui?token={token}", status_code=302)
\ No newline at end of file
@@ -7,15 +7,23 @@ Bootstrap runner:
 
 Usage: python run.py
 """
+import hashlib
+import importlib.metadata
 import os
+import re
 import subprocess
 import sys
 from pathlib import Path
+from typing import Dict, List
 import venv
 
 
 ROOT = Path(__file__).parent.resolve()
 VENV_DIR = ROOT / ".venv"
+# Digest of the requirements.txt last installed successfully into .venv
+REQ_STAMP = VENV_DIR / ".requirements.blake2b"
+# Plain 'name', 'name[extra]' or 'name==version' lines; anything fancier defers to pip
+REQ_LINE = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)(?:\[([^\]]*)\])?\s*(?:==\s*([A-Za-z0-9.+!_-]+))?$")
 
 
 def venv_python() -> Path:
@@ -32,15 +40,86 @@ def ensure_venv():
         print("Virtual environment exists.")
 
 
+def _normalize_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _extras_satisfied(dist: importlib.metadata.Distribution, extras: List[str], installed: Dict[str, importlib.metadata.Distribution]) -> bool:
+    """
+    Check that the distributions an installed package pulls in for the given extras
+    (e.g. uvloop/httptools for uvicorn[standard], h2 for httpx[http2]) are installed too.
+    Markers are evaluated for this interpreter, which also created .venv.
+    """
+    try:
+        from packaging.requirements import Requirement
+    except ImportError:
+        return False  # can't evaluate extra markers here; let pip decide
+    for spec in dist.requires or []:
+        try:
+            req = Requirement(spec)
+        except Exception:
+            return False
+        if req.marker is None:
+            continue  # base dependency, not pulled in by the extra
+        if any(req.marker.evaluate({"extra": e}) for e in extras):
+            if _normalize_name(req.name) not in installed:
+                return False
+    return True
+
+
+def _requirements_satisfied(req_file: Path) -> bool:
+    """
+    Check requirements.txt against the distributions already in .venv without starting pip.
+    Returns False on anything it cannot decide, so pip stays the source of truth.
+    """
+    site_dirs = [str(p) for p in VENV_DIR.glob("lib/python*/site-packages")]
+    site_dirs += [str(p) for p in VENV_DIR.glob("Lib/site-packages")]
+    if not site_dirs:
+        return False
+    installed: Dict[str, importlib.metadata.Distribution] = {}
+    for dist in importlib.metadata.distributions(path=site_dirs):
+        name = dist.metadata.get("Name")
+        if name:
+            installed[_normalize_name(name)] = dist
+    for raw in req_file.read_text(encoding="utf-8").splitlines():
+        line = raw.split("#", 1)[0].strip()
+        if not line:
+            continue
+        m = REQ_LINE.match(line)
+        if not m:
+            return False
+        have = installed.get(_normalize_name(m.group(1)))
+        if have is None or (m.group(3) and have.version != m.group(3)):
+            return False
+        extras = [e.strip() for e in (m.group(2) or "").split(",") if e.strip()]
+        if extras and not _extras_satisfied(have, extras, installed):
+            return False
+    return True
+
+
 def pip_install():
-    print("Installing dependencies ...")
     req = ROOT / "requirements.txt"
     if not req.exists():
         print("requirements.txt not found.")
         sys.exit(1)
+    # pip's resolver takes seconds even when everything is satisfied; skip it when
+    # requirements.txt is byte-identical to the last successful install.
+    digest = hashlib.blake2b(req.read_bytes(), digest_size=16).hexdigest()
+    try:
+        if REQ_STAMP.read_text(encoding="utf-8").strip() == digest:
+            print("requirements.txt unchanged, skipping pip install.")
+            return
+    except OSError:
+        pass
+    if _requirements_satisfied(req):
+        print("All requirements already installed, skipping pip install.")
+        REQ_STAMP.write_text(digest, encoding="utf-8")
+        return
+    print("Installing dependencies ...")
     cmd = [str(venv_python()), "-m", "pip", "install", "-U", "pip", "wheel", "setuptools"]
     subprocess.check_call(cmd)
     subprocess.check_call([str(venv_python()), "-m", "pip", "install", "-r", str(req)])
+    REQ_STAMP.write_text(digest, encoding="utf-8")
 
 
 def run_server():
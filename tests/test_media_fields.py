@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from app.main import _media_from_message_data  # noqa: E402
+
+
+def test_media_in_field_not_listed_for_its_type_is_kept():
+    # Accepted by the original generic scan: an imageMessage whose payload sits under documentMessageData
+    media = {"downloadUrl": "https://example.com/a.jpg", "fileName": "a.jpg", "mimeType": "image/jpeg"}
+    md = {"typeMessage": "imageMessage", "documentMessageData": media}
+    assert _media_from_message_data(md, "imagemessage") == [media]
+
+
+def test_text_type_with_file_payload_is_kept():
+    media = {"downloadUrl": "https://example.com/a.pdf", "fileName": "a.pdf"}
+    md = {"typeMessage": "textMessage", "fileMessageData": media}
+    assert _media_from_message_data(md, "textmessage") == [media]
+
+
+def test_listed_field_is_used_first():
+    media = {"downloadUrl": "https://example.com/a.jpg", "fileName": "a.jpg"}
+    md = {"typeMessage": "imageMessage", "fileMessageData": media}
+    assert _media_from_message_data(md, "imagemessage") == [media]
+
+
+def test_medias_array_is_appended():
+    first = {"downloadUrl": "https://example.com/1.jpg"}
+    second = {"downloadUrl": "https://example.com/2.jpg"}
+    md = {"typeMessage": "imageMessage", "imageMessageData": first, "medias": [second, "junk"]}
+    assert _media_from_message_data(md, "imagemessage") == [first, second]